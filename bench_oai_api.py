@@ -0,0 +1,414 @@
+#!/usr/bin/env python3
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+
+import httpx
+
+# Benchmark for oai_api.py. `mock` runs a stand-in for server.cpp that generates tokens at a fixed rate,
+# `run` starts the mock and the proxy and drives them with concurrent chat/completion requests, and
+# `chunk` times the per-token path that turns a server.cpp SSE line into an OpenAI chunk.
+
+WORDS = ["The", " quick", " brown", " fox", " jumps", " over", " the", " lazy", " dog", "."]
+
+
+def make_mock_app(mock_args):
+    from fastapi import FastAPI, Request
+    from fastapi.responses import StreamingResponse
+
+    app = FastAPI()
+    slots = asyncio.Semaphore(mock_args.slots)
+    speedup = mock_speedup(mock_args)
+    token_delay = 1.0 / (mock_args.tokens_per_second * speedup)
+    prompt_tokens_per_second = mock_args.prompt_tokens_per_second * speedup
+    if (mock_args.batch_size):
+        prompt_tokens_per_second *= min(mock_args.batch_size, 512) / 512
+
+    def timings(n_prompt, n_predict, prompt_ms, predicted_ms):
+        return {
+            "prompt_n": n_prompt,
+            "prompt_ms": prompt_ms,
+            "prompt_per_second": n_prompt / prompt_ms * 1000 if (prompt_ms) else 0,
+            "predicted_n": n_predict,
+            "predicted_ms": predicted_ms,
+            "predicted_per_second": n_predict / predicted_ms * 1000 if (predicted_ms) else 0,
+        }
+
+    def final(content, n_prompt, n_predict, prompt_ms, predicted_ms, slot):
+        return {
+            "content": content,
+            "stop": True,
+            "stopped_eos": n_predict < mock_args.n_predict,
+            "stopped_word": False,
+            "stopped_limit": n_predict >= mock_args.n_predict,
+            "tokens_evaluated": n_prompt,
+            "tokens_predicted": n_predict,
+            "truncated": False,
+            "slot_id": slot,
+            "timings": timings(n_prompt, n_predict, prompt_ms, predicted_ms),
+        }
+
+    @app.get('/health')
+    async def health():
+        return {"status": "ok"}
+
+    @app.get('/props')
+    async def props():
+        return {"default_generation_settings": {"model": mock_args.model, "n_ctx": mock_args.ctx_size},
+                "total_slots": mock_args.slots}
+
+    @app.post('/tokenize')
+    async def tokenize(request: Request):
+        body = json.loads(await request.body())
+        # Roughly four characters per token, like a real vocabulary on English text
+        return {"tokens": list(range(max(1, len(body["content"]) // 4)))}
+
+    @app.post('/embedding')
+    async def embedding(request: Request):
+        body = json.loads(await request.body())
+        seed = len(body["content"])
+        return {"embedding": [((seed * (i + 1)) % 97) / 97.0 for i in range(mock_args.n_embd)]}
+
+    @app.post('/completion')
+    async def completion(request: Request):
+        body = json.loads(await request.body())
+        n_prompt = max(1, len(body.get("prompt", "")) // 4)
+        n_predict = body.get("n_predict", -1)
+        n_predict = mock_args.n_predict if (n_predict is None or n_predict < 0) else min(n_predict, mock_args.n_predict)
+        prompt_ms = n_prompt / prompt_tokens_per_second * 1000
+
+        if (not body.get("stream")):
+            async with slots:
+                await asyncio.sleep(prompt_ms / 1000 + n_predict * token_delay)
+            content = "".join(WORDS[i % len(WORDS)] for i in range(n_predict))
+            return final(content, n_prompt, n_predict, prompt_ms, n_predict * token_delay * 1000, 0)
+
+        async def generate():
+            async with slots:
+                await asyncio.sleep(prompt_ms / 1000)
+                start = time.monotonic()
+                for i in range(n_predict):
+                    await asyncio.sleep(token_delay)
+                    chunk = {"content": WORDS[i % len(WORDS)], "stop": False, "slot_id": 0}
+                    yield "data: {}\n\n".format(json.dumps(chunk))
+                chunk = final("", n_prompt, n_predict, prompt_ms, (time.monotonic() - start) * 1000, 0)
+                yield "data: {}\n\n".format(json.dumps(chunk))
+
+        return StreamingResponse(generate(), media_type="text/event-stream")
+
+    return app
+
+
+# How much faster the mock is with the server.cpp performance options it was given, so tuning them against it
+# has a best setting: threads help up to --cores and slow it down beyond, every GPU layer adds a little and a
+# batch size up to 512 speeds up prompt processing
+def mock_speedup(mock_args):
+    speedup = 1.0
+    if (mock_args.threads):
+        speedup *= min(mock_args.threads, mock_args.cores) / mock_args.cores
+        if (mock_args.threads > mock_args.cores):
+            speedup *= mock_args.cores / mock_args.threads
+    if (mock_args.n_gpu_layers):
+        speedup *= 1 + mock_args.n_gpu_layers / 32
+    return speedup
+
+
+def run_mock(mock_args):
+    import uvicorn
+
+    # Announce readiness the way server.cpp does, so the launcher can wait for it
+    print(json.dumps({"level": "INFO", "function": "main", "message": "HTTP server listening",
+                      "hostname": mock_args.host, "port": mock_args.port}), flush=True)
+    uvicorn.run(make_mock_app(mock_args), host=mock_args.host, port=mock_args.port, log_level="warning")
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+async def wait_ready(url, timeout=30.0):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while (time.monotonic() < deadline):
+            try:
+                if ((await client.get(url)).status_code == 200):
+                    return
+            except httpx.HTTPError:
+                pass
+            await asyncio.sleep(0.1)
+    raise RuntimeError("{} did not become ready".format(url))
+
+
+def proc_stat(pid):
+    try:
+        with open("/proc/{}/stat".format(pid)) as f:
+            return f.read().rsplit(")", 1)[1].split()
+    except OSError:
+        return None
+
+
+# CPU seconds used so far by a process and its live children (the workers of --workers), from /proc on Linux
+def cpu_seconds(pid):
+    fields = proc_stat(pid)
+    if (fields is None):
+        return None
+    total = int(fields[11]) + int(fields[12])
+    for entry in os.listdir("/proc"):
+        if (entry.isdigit()):
+            child = proc_stat(entry)
+            if (child is not None and child[1] == str(pid)):
+                total += int(child[11]) + int(child[12])
+    return total / os.sysconf("SC_CLK_TCK")
+
+
+def percentile(values, p):
+    if (not values):
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, int(round(p / 100 * len(values) + 0.5)) - 1))]
+
+
+def rounded(value):
+    return None if (value is None) else round(value, 2)
+
+
+def make_body(run_args, i):
+    chat = run_args.workload == "chat" or (run_args.workload == "mixed" and i % 2 == 0)
+    body = {"max_tokens": run_args.max_tokens, "stream": run_args.stream}
+    text = "Benchmark request {} ".format(i) + "lorem ipsum " * (run_args.prompt_chars // 12)
+    if (chat):
+        body["messages"] = [{"role": "user", "content": text}]
+    else:
+        body["prompt"] = text
+    return ("/v1/chat/completions" if (chat) else "/v1/completions"), body
+
+
+async def one_request(client, run_args, i):
+    path, body = make_body(run_args, i)
+    start = time.monotonic()
+    first = None
+    tokens = 0
+    if (run_args.stream):
+        async with client.stream("POST", path, json=body) as res:
+            if (res.status_code != 200):
+                return {"error": res.status_code}
+            async for line in res.aiter_lines():
+                if (not line.startswith("data: ") or line == "data: [DONE]"):
+                    continue
+                choice = json.loads(line[6:])["choices"][0]
+                if (choice.get("text") or choice.get("delta", {}).get("content")):
+                    tokens += 1
+                    if (first is None):
+                        first = time.monotonic()
+    else:
+        res = await client.post(path, json=body)
+        if (res.status_code != 200):
+            return {"error": res.status_code}
+        tokens = res.json()["usage"]["completion_tokens"]
+    end = time.monotonic()
+    first = first or end
+    return {"ttft": first - start, "latency": end - start, "tokens": tokens,
+            "rate": (tokens - 1) / (end - first) if (tokens > 1 and end > first) else None}
+
+
+async def drive(run_args, proxy_url, proxy_pid):
+    limits = httpx.Limits(max_connections=run_args.concurrency, max_keepalive_connections=run_args.concurrency)
+    async with httpx.AsyncClient(base_url=proxy_url, limits=limits, timeout=None) as client:
+        queue = asyncio.Queue()
+        for i in range(run_args.requests):
+            queue.put_nowait(i)
+        results = []
+
+        async def worker():
+            while (not queue.empty()):
+                i = queue.get_nowait()
+                try:
+                    results.append(await one_request(client, run_args, i))
+                except httpx.HTTPError as e:
+                    results.append({"error": type(e).__name__})
+
+        cpu_start = cpu_seconds(proxy_pid) if (proxy_pid) else None
+        start = time.monotonic()
+        await asyncio.gather(*[worker() for _ in range(run_args.concurrency)])
+        wall = time.monotonic() - start
+        cpu_end = cpu_seconds(proxy_pid) if (proxy_pid) else None
+
+    ok = [r for r in results if ("error" not in r)]
+    errors = [r["error"] for r in results if ("error" in r)]
+    report = {
+        "requests": len(results),
+        "errors": len(errors),
+        "wall_seconds": round(wall, 3),
+        "requests_per_second": round(len(ok) / wall, 2),
+        "tokens_per_second": round(sum(r["tokens"] for r in ok) / wall, 2),
+    }
+    for name in ("ttft", "latency"):
+        values = [r[name] * 1000 for r in ok]
+        for p in (50, 95, 99):
+            report["{}_p{}_ms".format(name, p)] = rounded(percentile(values, p))
+    rates = [r["rate"] for r in ok if (r["rate"])]
+    report["stream_tokens_per_second_p50"] = rounded(percentile(rates, 50))
+    if (cpu_start is not None and cpu_end is not None):
+        cpu = cpu_end - cpu_start
+        report["proxy_cpu_seconds"] = round(cpu, 3)
+        report["proxy_cpu_ms_per_request"] = round(cpu / max(1, len(ok)) * 1000, 3)
+        report["proxy_cpu_percent"] = round(cpu / wall * 100, 1)
+    if (errors):
+        report["error_kinds"] = sorted(set(str(e) for e in errors))
+    return report
+
+
+def run_bench(run_args):
+    processes = []
+    proxy_pid = None
+    try:
+        proxy_url = run_args.proxy_url
+        if (not proxy_url):
+            mock_port = free_port()
+            proxy_port = free_port()
+            processes.append(subprocess.Popen(
+                [sys.executable, __file__, "mock", "--port", str(mock_port),
+                 "--tokens-per-second", str(run_args.tokens_per_second),
+                 "--prompt-tokens-per-second", str(run_args.prompt_tokens_per_second),
+                 "--slots", str(run_args.slots)],
+                stdout=subprocess.DEVNULL))
+            proxy = subprocess.Popen(
+                [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "oai_api.py"),
+                 "--port", str(proxy_port), "--llama-api", "http://127.0.0.1:{}".format(mock_port)]
+                + run_args.proxy_args,
+                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            processes.append(proxy)
+            proxy_pid = proxy.pid
+            proxy_url = "http://127.0.0.1:{}".format(proxy_port)
+            asyncio.run(wait_ready("http://127.0.0.1:{}/health".format(mock_port)))
+        asyncio.run(wait_ready(proxy_url + "/v1/models"))
+        report = asyncio.run(drive(run_args, proxy_url, proxy_pid))
+    finally:
+        for process in processes:
+            process.terminate()
+            process.wait()
+    print(json.dumps(report, indent=2))
+
+
+def load_proxy():
+    import importlib.util
+    argv = sys.argv
+    sys.argv = [argv[0]]
+    try:
+        spec = importlib.util.spec_from_file_location(
+            "oai_api", os.path.join(os.path.dirname(os.path.abspath(__file__)), "oai_api.py"))
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    finally:
+        sys.argv = argv
+    return module
+
+
+def time_chunks(convert, lines, rounds):
+    best = None
+    for _ in range(rounds):
+        start = time.perf_counter()
+        for line in lines:
+            convert(line)
+        elapsed = time.perf_counter() - start
+        best = elapsed if (best is None or elapsed < best) else best
+    return round(best / len(lines) * 1e9)
+
+
+def run_chunk_bench(chunk_args):
+    proxy = load_proxy()
+    lines = []
+    for i in range(chunk_args.chunks):
+        lines.append(b"data: " + json.dumps({
+            "content": WORDS[i % len(WORDS)] + ("\u00e9\"\n" if (i % 7 == 0) else ""),
+            "stop": False, "id_slot": 0, "multimodal": False}).encode())
+
+    # The conversion as it was before the pre-serialized chunks: str decode, dict per token, json.dumps
+    def legacy(line):
+        text = line.decode("utf-8")
+        chunk = json.loads(text[6:])
+        resData = proxy.make_resData_stream(chunk, chat=chunk_args.chat, time_now=0)
+        return 'data: {}\n\n'.format(json.dumps(resData)).encode()
+
+    def spliced(line):
+        chunk = proxy.json_loads(line[6:])
+        return encoder.encode(chunk["content"])
+
+    report = {"chunks": len(lines), "chat": chunk_args.chat,
+              "legacy_ns_per_chunk": time_chunks(legacy, lines, chunk_args.rounds)}
+    backends = [("stdlib", json.loads, lambda value: json.dumps(value, ensure_ascii=False,
+                                                                separators=(",", ":")).encode())]
+    if (proxy.orjson is not None):
+        backends.append(("orjson", proxy.orjson.loads, proxy.orjson.dumps))
+    for name, loads, dumps in backends:
+        proxy.json_loads, proxy.json_dumps = loads, dumps
+        encoder = proxy.ChunkEncoder(chat=chunk_args.chat)
+        report["spliced_{}_ns_per_chunk".format(name)] = time_chunks(spliced, lines, chunk_args.rounds)
+    print(json.dumps(report, indent=2))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark oai_api.py against a mock server.cpp.")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    mock = sub.add_parser("mock", help="Run a mock server.cpp")
+    mock.add_argument("--host", type=str, default="127.0.0.1")
+    mock.add_argument("--port", type=int, default=8080)
+    mock.add_argument("--tokens-per-second", type=float, default=50.0, help="Generation speed per slot(default: 50)")
+    mock.add_argument("--prompt-tokens-per-second", type=float, default=1000.0,
+                      help="Prompt processing speed(default: 1000)")
+    mock.add_argument("--slots", type=int, default=4, help="Requests generated in parallel(default: 4)")
+    mock.add_argument("--n-predict", type=int, default=128, help="Most tokens generated per request(default: 128)")
+    mock.add_argument("--n-embd", type=int, default=64, help="Size of the returned embeddings(default: 64)")
+    mock.add_argument("--model", type=str, default="mock-model.gguf", help="Model path reported by /props")
+    mock.add_argument("--ctx-size", type=int, default=2048)
+    mock.add_argument("--threads", type=int, default=0, help="Scale the speed as if run with this many threads")
+    mock.add_argument("--cores", type=int, default=8, help="Threads the mock speed peaks at(default: 8)")
+    mock.add_argument("--batch-size", type=int, default=0, help="Scale the prompt speed by the batch size")
+    mock.add_argument("--n-gpu-layers", type=int, default=0, help="Scale the speed by the offloaded layers")
+
+    run = sub.add_parser("run", help="Start the mock and the proxy and benchmark them")
+    run.add_argument("--proxy-url", type=str, default="", help="Benchmark an already running proxy instead")
+    run.add_argument("--concurrency", type=int, default=16, help="Requests in flight(default: 16)")
+    run.add_argument("--requests", type=int, default=200, help="Total requests(default: 200)")
+    run.add_argument("--workload", type=str, choices=["chat", "completion", "mixed"], default="chat")
+    run.add_argument("--no-stream", dest="stream", action="store_false", help="Use non-stream requests")
+    run.add_argument("--max-tokens", type=int, default=64, help="max_tokens of every request(default: 64)")
+    run.add_argument("--prompt-chars", type=int, default=400, help="Prompt length in characters(default: 400)")
+    run.add_argument("--tokens-per-second", type=float, default=200.0, help="Mock generation speed(default: 200)")
+    run.add_argument("--prompt-tokens-per-second", type=float, default=5000.0,
+                     help="Mock prompt processing speed(default: 5000)")
+    run.add_argument("--slots", type=int, default=16, help="Mock parallel slots(default: 16)")
+    run.add_argument("proxy_args", nargs=argparse.REMAINDER,
+                     help="Extra arguments for oai_api.py, given after --")
+
+    chunk = sub.add_parser("chunk", help="Time the conversion of one streamed token in the proxy")
+    chunk.add_argument("--chunks", type=int, default=20000, help="Chunks converted per round(default: 20000)")
+    chunk.add_argument("--rounds", type=int, default=5, help="Rounds, the fastest is reported(default: 5)")
+    chunk.add_argument("--completion", dest="chat", action="store_false",
+                       help="Time completion chunks instead of chat chunks")
+
+    # server.cpp options the launcher passes along are accepted and ignored by the mock
+    bench_args, unknown = parser.parse_known_args()
+    if (bench_args.command == "mock"):
+        run_mock(bench_args)
+    elif (bench_args.command == "chunk"):
+        if (unknown):
+            parser.error("unrecognized arguments: {}".format(" ".join(unknown)))
+        run_chunk_bench(bench_args)
+    else:
+        if (unknown):
+            parser.error("unrecognized arguments: {}".format(" ".join(unknown)))
+        bench_args.proxy_args = [a for a in bench_args.proxy_args if (a != "--")]
+        run_bench(bench_args)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,31 +1,336 @@
 #!/usr/bin/env python3
 import configparser
+import csv
+import ctypes
+import glob
+import json
+import logging
+import logging.handlers
+import mmap
 import os
 import platform
 import re
+import secrets
+import shlex
+import shutil
+import socket
+import struct
 import subprocess
 import sys
 import threading
 import time  # Import the time module
+import urllib.error
+import urllib.request
+from collections import deque
 
-from PyQt5.QtCore import Qt, pyqtSignal, QObject
+from PyQt5.QtCore import Qt, pyqtSignal, QObject, QTimer
+from PyQt5.QtGui import QFontDatabase
 from PyQt5.QtWidgets import QApplication, QMainWindow, QLabel, QPushButton, QFileDialog, QSpinBox, QVBoxLayout, \
-    QLineEdit, QHBoxLayout, QPlainTextEdit, QCheckBox, QTabWidget, QWidget
+    QLineEdit, QHBoxLayout, QPlainTextEdit, QCheckBox, QTabWidget, QWidget, QListWidget, QTableWidget, \
+    QTableWidgetItem, QAbstractItemView, QHeaderView, QComboBox
+
+
+# Logged by server.cpp once it accepts requests, older builds print it after loading the model
+LISTENING_RE = re.compile(r'HTTP server listening|server is listening')
+
+# ANSI escape codes (used for formatting in some terminals)
+ANSI_RE = re.compile(r'\x1B\[[0-?]*[ -/]*[@-~]')
+
+
+# Output of server.cpp and the OpenAI wrapper on its way to the output view. The reader threads clean
+# the lines and queue them, and a timer on the GUI thread appends what arrived since the last tick in
+# one go. At most max_lines wait in the queue and stay in the view, older ones are dropped.
+class LogPipeline:
+    def __init__(self, output, interval=100, max_lines=5000):
+        self.output = output
+        self.output.setMaximumBlockCount(max_lines)
+        self.pending = deque(maxlen=max_lines)
+        self.dropped = 0
+        self.lock = threading.Lock()
+        self.logger = None
+        self.timer = QTimer()
+        self.timer.timeout.connect(self.flush)
+        self.timer.start(interval)
+
+    # Called from the reader threads, returns the cleaned line
+    def write(self, line):
+        line = ANSI_RE.sub('', line).strip()
+        logger = self.logger
+        if logger is not None:
+            logger.info(line)
+        with self.lock:
+            if len(self.pending) == self.pending.maxlen:
+                self.dropped += 1
+            self.pending.append(line)
+        return line
+
+    def flush(self):
+        with self.lock:
+            if not self.pending:
+                return
+            lines = list(self.pending)
+            self.pending.clear()
+            dropped = self.dropped
+            self.dropped = 0
+        if dropped:
+            lines.insert(0, '... %d lines skipped' % dropped)
+        self.output.appendPlainText('\n'.join(lines))
+
+    # Also write the lines to a log file rotated at 10 MB, or stop with None
+    def set_log_file(self, path):
+        logger = logging.getLogger('llama.cpp-qt.output')
+        for handler in list(logger.handlers):
+            logger.removeHandler(handler)
+            handler.close()
+        if not path:
+            self.logger = None
+            return
+        handler = logging.handlers.RotatingFileHandler(path, maxBytes=10 * 1024 * 1024, backupCount=3,
+                                                       encoding='utf-8')
+        handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+        logger.addHandler(handler)
+        logger.setLevel(logging.INFO)
+        logger.propagate = False
+        self.logger = logger
+
+
+# Timings server.cpp prints after each request, as plain text ("print_timings: prompt eval time = ...", or
+# on lines of their own after "slot print_timing: id 0 | ...") or in the msg of its JSON log lines
+PROMPT_TIMING_RE = re.compile(r'prompt eval time\s*=\s*([\d.]+) ms\s*/\s*(\d+) (?:tokens|runs)')
+EVAL_TIMING_RE = re.compile(r'(?<!prompt )eval time\s*=\s*([\d.]+) ms\s*/\s*(\d+) (?:tokens|runs)')
+TOTAL_TIMING_RE = re.compile(r'total time\s*=\s*([\d.]+) ms')
+# Slot of a log line: "slot release: id  0 | ...", "slot 0 released ...", "slot_id":0 or "id_slot":0
+SLOT_ID_RE = re.compile(r'\b(?:slot_id|id_slot)"?\s*[:=]\s*(\d+)|\bslot\s+(?:\w+:\s+id\s+)?(\d+)')
+SLOT_BUSY_RE = re.compile(r'processing task|is processing')
+SLOT_IDLE_RE = re.compile(r'\brelease(?:d\b|:)')
+N_SLOTS_RE = re.compile(r'\bn_slots"?\s*[:=]\s*(\d+)')
+SAMPLE_FIELDS = ['time', 'model', 'slot', 'prompt_tokens', 'prompt_ms', 'prompt_tokens_per_second',
+                 'generated_tokens', 'generation_ms', 'generation_tokens_per_second', 'total_ms']
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+# Requests and slot use of the server.cpp processes, parsed from their output. feed() runs in the reader
+# threads, one sample is kept per finished request and the busy slots are integrated over time for the
+# utilisation.
+class PerfStats:
+    def __init__(self, max_samples=100000):
+        self.lock = threading.Lock()
+        self.samples = deque(maxlen=max_samples)
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.samples.clear()
+            self.parsing = {}  # Sample of each model whose timings are being printed
+            self.timing_slot = {}
+            self.busy = {}  # Busy slots of each model
+            self.n_slots = {}
+            self.busy_seconds = 0.0
+            self.slot_seconds = 0.0
+            self.updated_at = time.time()
+
+    # Add the slot time since the last update, called with the lock held
+    def advance(self):
+        now = time.time()
+        self.busy_seconds += sum(len(busy) for busy in self.busy.values()) * (now - self.updated_at)
+        self.slot_seconds += sum(self.n_slots.values()) * (now - self.updated_at)
+        self.updated_at = now
+
+    def feed(self, model, line):
+        with self.lock:
+            m = N_SLOTS_RE.search(line)
+            if m:
+                self.advance()
+                self.n_slots[model] = int(m.group(1))
+            m = SLOT_ID_RE.search(line)
+            slot = int(m.group(1) or m.group(2)) if m else None
+            if slot is not None:
+                if 'print_timing' in line:
+                    self.timing_slot[model] = slot
+                busy = SLOT_BUSY_RE.search(line)
+                if busy or SLOT_IDLE_RE.search(line):
+                    self.advance()
+                    self.n_slots[model] = max(self.n_slots.get(model, 0), slot + 1)
+                    slots = self.busy.setdefault(model, set())
+                    if busy:
+                        slots.add(slot)
+                    else:
+                        slots.discard(slot)
+
+            m = PROMPT_TIMING_RE.search(line)
+            if m:
+                self.parsing[model] = {'model': model, 'slot': slot if slot is not None else
+                                       self.timing_slot.get(model, ''),
+                                       'prompt_ms': float(m.group(1)), 'prompt_tokens': int(m.group(2))}
+                return
+            m = EVAL_TIMING_RE.search(line)
+            if m:
+                sample = self.parsing.setdefault(model, {'model': model, 'slot': self.timing_slot.get(model, '')})
+                sample['generation_ms'] = float(m.group(1))
+                sample['generated_tokens'] = int(m.group(2))
+                return
+            m = TOTAL_TIMING_RE.search(line)
+            if m and model in self.parsing:
+                sample = self.parsing.pop(model)
+                sample['time'] = time.time()
+                sample['total_ms'] = float(m.group(1))
+                for tokens, ms, rate in (('prompt_tokens', 'prompt_ms', 'prompt_tokens_per_second'),
+                                         ('generated_tokens', 'generation_ms', 'generation_tokens_per_second')):
+                    if sample.get(ms):
+                        sample[rate] = sample[tokens] * 1000 / sample[ms]
+                self.samples.append(sample)
+
+    # A stopped server.cpp has no busy slots left
+    def forget(self, model):
+        with self.lock:
+            self.advance()
+            self.busy.pop(model, None)
+            self.n_slots.pop(model, None)
+            self.parsing.pop(model, None)
+
+    # The busy and total slots now, with the busy and total slot seconds so far
+    def slot_use(self):
+        with self.lock:
+            self.advance()
+            return (sum(len(busy) for busy in self.busy.values()), sum(self.n_slots.values()),
+                    self.busy_seconds, self.slot_seconds)
+
+    def snapshot(self):
+        with self.lock:
+            return list(self.samples)
+
+    def write_csv(self, path):
+        with open(path, 'w', newline='') as csvfile:
+            writer = csv.DictWriter(csvfile, fieldnames=SAMPLE_FIELDS, extrasaction='ignore')
+            writer.writeheader()
+            for sample in self.snapshot():
+                row = dict(sample)
+                row['time'] = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(sample['time']))
+                writer.writerow(row)
+
+
+# "0-3,8,10-11" to [0, 1, 2, 3, 8, 10, 11], raises ValueError if it is no CPU list
+def parse_cpulist(text):
+    cpus = set()
+    for part in text.replace(' ', '').split(','):
+        if not part:
+            continue
+        first, _, last = part.partition('-')
+        cpus.update(range(int(first), int(last or first) + 1))
+    return sorted(cpus)
+
+
+def format_cpulist(cpus):
+    ranges = []
+    for cpu in sorted(cpus):
+        if ranges and ranges[-1][1] == cpu - 1:
+            ranges[-1][1] = cpu
+        else:
+            ranges.append([cpu, cpu])
+    return ','.join(str(first) if first == last else '%d-%d' % (first, last) for first, last in ranges)
+
+
+# NUMA nodes and their CPUs from /sys, with the number of physical cores each, as {node: (cpus, cores)}.
+# Without NUMA information all CPUs this process may use are one node.
+def cpu_topology():
+    nodes = {}
+    for path in glob.glob('/sys/devices/system/node/node[0-9]*/cpulist'):
+        try:
+            with open(path) as f:
+                cpus = parse_cpulist(f.read().strip())
+        except (OSError, ValueError):
+            continue
+        if cpus:
+            nodes[int(os.path.basename(os.path.dirname(path))[4:])] = cpus
+    if not nodes:
+        nodes[0] = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else \
+            list(range(os.cpu_count() or 1))
+    return {node: (cpus, physical_cores(cpus)) for node, cpus in sorted(nodes.items())}
+
+
+# Hyper-threads share a core, and the cores of the CPUs are what the thread count should match
+def physical_cores(cpus):
+    cores = set()
+    for cpu in cpus:
+        topology = '/sys/devices/system/cpu/cpu%d/topology/' % cpu
+        try:
+            with open(topology + 'physical_package_id') as package, open(topology + 'core_id') as core:
+                cores.add((package.read().strip(), core.read().strip()))
+        except OSError:
+            cores.add(cpu)
+    return len(cores)
+
+
+# Where and how server.cpp or the OpenAI wrapper run: pinned to CPUs through taskset, with memory bound to a
+# NUMA node through numactl, and with a nice level and I/O priority class (2 best effort at the lowest level,
+# 3 idle) through nice and ionice. wrap() prefixes the command, so the settings hold from the start for every
+# thread the process starts. Missing tools are reported to log.
+class LaunchProfile:
+    def __init__(self, cpus=None, node=None, membind=False, nice=0, io_class=0, log=None):
+        self.cpus = cpus
+        self.node = node
+        self.membind = membind
+        self.nice = nice
+        self.io_class = io_class
+        self.log = log
+
+    def report(self, message):
+        if self.log is not None:
+            self.log.write(message)
+        else:
+            print(message)
+
+    def wrap(self, cmd):
+        prefix = []
+        if self.cpus:
+            if shutil.which('taskset'):
+                prefix += ['taskset', '-c', ','.join(str(cpu) for cpu in sorted(self.cpus))]
+            else:
+                self.report('taskset not found, the process is not pinned to CPUs')
+        if self.membind and self.node is not None:
+            if shutil.which('numactl'):
+                prefix += ['numactl', '--cpunodebind=%d' % self.node, '--membind=%d' % self.node]
+            else:
+                self.report('numactl not found, memory is not bound to NUMA node %d' % self.node)
+        if self.nice:
+            if shutil.which('nice'):
+                prefix += ['nice', '-n', str(self.nice)]
+            else:
+                self.report('nice not found, the priority is not lowered')
+        if self.io_class:
+            if shutil.which('ionice'):
+                prefix += ['ionice', '-c', str(self.io_class)] + (['-n', '7'] if self.io_class == 2 else [])
+            else:
+                self.report('ionice not found, the I/O priority is not lowered')
+        return prefix + list(cmd)
 
 
 class ServerRunner(QObject):
     started = pyqtSignal()
     stopped = pyqtSignal()
-    output_received = pyqtSignal(str)
 
-    def __init__(self, cmd):
+    def __init__(self, cmd, log, stats=None, name='', profile=None):
         super().__init__()
         self.cmd = cmd
+        self.log = log
+        self.stats = stats
+        self.name = name
+        self.profile = profile
         self.process = None
+        self.started_at = time.time()
+        # Set once server.cpp logs that its HTTP server is listening
+        self.listening = threading.Event()
 
     def run_server(self):
+        self.started_at = time.time()
         self.process = subprocess.Popen(
-            self.cmd,
+            self.profile.wrap(self.cmd) if self.profile else self.cmd,
             stdout=subprocess.PIPE,
             stderr=subprocess.STDOUT,
             universal_newlines=True
@@ -37,13 +342,473 @@ class ServerRunner(QObject):
             line = self.process.stdout.readline()
             if not line:
                 break
-            self.output_received.emit(line)
+            if not self.listening.is_set() and LISTENING_RE.search(line):
+                self.listening.set()
+            line = self.log.write(line)
+            if self.stats is not None:
+                self.stats.feed(self.name, line)
 
         self.process.wait()
         self.stopped.emit()
 
 
+# Poll /health of a server.cpp until the model is loaded, giving up after timeout seconds or once alive()
+# is False. The polls back off while it loads, and the `listening` event of its log cuts the wait short.
+def wait_for_server(url, timeout=3600, alive=None, listening=None):
+    deadline = time.time() + timeout
+    delay = 0.1
+    while time.time() < deadline:
+        if alive is not None and not alive():
+            return False
+        try:
+            with urllib.request.urlopen(url + "/health", timeout=2) as response:
+                if response.status == 200:
+                    return True
+        except urllib.error.HTTPError as e:
+            # Older builds have no /health and only listen once loaded, newer ones answer 503 while loading
+            if e.code == 404:
+                return True
+        except OSError:
+            pass
+        if listening is not None and not listening.is_set():
+            if listening.wait(delay):
+                delay = 0.1
+                continue
+        else:
+            time.sleep(delay)
+        delay = min(delay * 2, 2.0)
+    return False
+
+
+def post_json(url, data, key="", timeout=30):
+    request = urllib.request.Request(url, data=json.dumps(data).encode(), method="POST",
+                                     headers={"Content-Type": "application/json", "Authorization": "Bearer " + key})
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        return json.loads(response.read())
+
+
+def get_json(url, key="", timeout=30):
+    request = urllib.request.Request(url, headers={"Authorization": "Bearer " + key})
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        return json.loads(response.read())
+
+
+# Seconds a replaced server.cpp may take to finish the requests it is answering before it is stopped anyway
+DRAIN_GRACE = 60
+
+
+# Auto-tune workload: a prompt of about 512 tokens evaluated without generating, and 64 generated tokens.
+# A configuration scores the seconds a request with that prompt and 128 generated tokens would take.
+TUNE_PROMPT = ' '.join(['The quick brown fox jumps over the lazy dog.'] * 50)
+TUNE_PREDICT = 64
+
+
+def set_option(cmd, option, value):
+    cmd = list(cmd)
+    if option in cmd:
+        cmd[cmd.index(option) + 1] = str(value)
+    else:
+        cmd += [option, str(value)]
+    return cmd
+
+
+# Tokens per second of one request, from the timings server.cpp returns or the wall clock if it has none
+def timed_completion(url, data, rate):
+    started = time.time()
+    response = post_json(url + "/completion", data, timeout=1800)
+    timings = response.get("timings") or {}
+    if timings.get(rate):
+        return timings[rate]
+    tokens = response.get("tokens_evaluated" if rate == "prompt_per_second" else "tokens_predicted", 0)
+    return tokens / max(time.time() - started, 1e-6)
+
+
+# Start server.cpp with cmd and measure its prompt and generation speed, returns None if it fails to load
+def measure_server(cmd, url, cancel, profile=None):
+    process = subprocess.Popen(profile.wrap(cmd) if profile else cmd, stdout=subprocess.DEVNULL,
+                               stderr=subprocess.DEVNULL)
+    try:
+        if not wait_for_server(url, timeout=1800, alive=lambda: process.poll() is None and not cancel.is_set()):
+            return None
+        post_json(url + "/completion", {"prompt": "Hello", "n_predict": 4}, timeout=1800)  # Warm up
+        prompt_tps = timed_completion(url, {"prompt": TUNE_PROMPT, "n_predict": 1, "cache_prompt": False},
+                                      "prompt_per_second")
+        gen_tps = timed_completion(url, {"prompt": "Once upon a time", "n_predict": TUNE_PREDICT,
+                                         "ignore_eos": True, "cache_prompt": False}, "predicted_per_second")
+        return prompt_tps, gen_tps
+    except (OSError, ValueError) as e:
+        print("Auto-tune measurement failed:", e)
+        return None
+    finally:
+        process.terminate()
+        process.wait()
+
+
+# Find the fastest values for the server.cpp options in sweeps, a list of (option, candidate values), one
+# option at a time starting from the values in start. progress(text) reports each measurement.
+def tune_server(base_cmd, url, start, sweeps, progress, cancel, profile=None):
+    best = dict(start)
+    best_score = None
+    best_speed = None
+    measured = {}
+    for option, values in sweeps:
+        for value in values:
+            if cancel.is_set():
+                return None
+            config = dict(best, **{option: value})
+            key = tuple(sorted(config.items()))
+            if key in measured:
+                continue
+            cmd = base_cmd
+            for name, config_value in config.items():
+                cmd = set_option(cmd, name, config_value)
+            description = ' '.join('%s %s' % item for item in sorted(config.items()))
+            progress('Measuring ' + description + '...')
+            speed = measured[key] = measure_server(cmd, url, cancel, profile)
+            if speed is None:
+                continue
+            prompt_tps, gen_tps = speed
+            score = 512 / prompt_tps + 128 / gen_tps
+            progress('%s: prompt %.1f, generation %.1f tokens/s' % (description, prompt_tps, gen_tps))
+            if best_score is None or score < best_score:
+                best, best_score, best_speed = config, score, speed
+    if best_speed is None:
+        return None
+    return dict(best, prompt_tps=best_speed[0], gen_tps=best_speed[1])
+
+
+# Scalar value types of GGUF metadata as struct formats, 8 is a string and 9 an array
+GGUF_SCALARS = {0: '<B', 1: '<b', 2: '<H', 3: '<h', 4: '<I', 5: '<i', 6: '<f', 7: '<?', 10: '<Q', 11: '<q', 12: '<d'}
+GGML_TYPES = {0: 'F32', 1: 'F16', 2: 'Q4_0', 3: 'Q4_1', 6: 'Q5_0', 7: 'Q5_1', 8: 'Q8_0', 9: 'Q8_1', 10: 'Q2_K',
+              11: 'Q3_K', 12: 'Q4_K', 13: 'Q5_K', 14: 'Q6_K', 15: 'Q8_K', 16: 'IQ2_XXS', 17: 'IQ2_XS',
+              18: 'IQ3_XXS', 19: 'IQ1_S', 20: 'IQ4_NL', 21: 'IQ3_S', 22: 'IQ2_S', 23: 'IQ4_XS', 24: 'I8',
+              25: 'I16', 26: 'I32', 27: 'I64', 28: 'F64', 29: 'IQ1_M', 30: 'BF16', 34: 'TQ1_0', 35: 'TQ2_0'}
+# Memory server.cpp takes on the GPU besides weights, KV cache and compute buffers
+GPU_OVERHEAD = 512 * 1024 * 1024
+
+
+# Metadata and tensor sizes of a GGUF model, read through a memory map so only the header pages are
+# touched. Arrays are skipped except for their length, and tensor sizes come from the data offsets.
+class GGUFInfo:
+    def __init__(self, path):
+        self.path = path
+        self.metadata = {}
+        self.tensors = []  # (name, ggml type, bytes)
+        with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            if data[:4] != b'GGUF':
+                raise ValueError('not a GGUF file')
+            self.version, = struct.unpack_from('<I', data, 4)
+            count = '<I' if self.version == 1 else '<Q'
+            self.pos = 8
+            n_tensors = self.read(data, count)
+            n_metadata = self.read(data, count)
+            for _ in range(n_metadata):
+                key = self.read_string(data, count)
+                self.metadata[key] = self.read_value(data, count, self.read(data, '<I'))
+            infos = []
+            for _ in range(n_tensors):
+                name = self.read_string(data, count)
+                n_dims = self.read(data, '<I')
+                self.pos += n_dims * struct.calcsize(count)
+                ggml_type = self.read(data, '<I')
+                infos.append((self.read(data, '<Q'), name, ggml_type))
+            alignment = self.metadata.get('general.alignment', 32)
+            data_start = (self.pos + alignment - 1) // alignment * alignment
+            infos.sort()
+            ends = [offset for offset, _, _ in infos[1:]] + [len(data) - data_start]
+            for (offset, name, ggml_type), end in zip(infos, ends):
+                self.tensors.append((name, ggml_type, end - offset))
+        del self.pos
+
+        arch = self.metadata.get('general.architecture', 'llama')
+        self.name = self.metadata.get('general.name', os.path.basename(path))
+        self.n_layers = self.metadata.get(arch + '.block_count', 0)
+        self.n_ctx_train = self.metadata.get(arch + '.context_length', 0)
+        self.n_embd = self.metadata.get(arch + '.embedding_length', 0)
+        self.n_head = self.metadata.get(arch + '.attention.head_count', 1)
+        n_head_kv = self.metadata.get(arch + '.attention.head_count_kv', self.n_head)
+        # Some architectures have a count per layer
+        self.n_head = max(self.n_head) if isinstance(self.n_head, list) else self.n_head
+        n_head_kv = max(n_head_kv) if isinstance(n_head_kv, list) else n_head_kv
+        head_dim = self.n_embd // self.n_head if self.n_head else 0
+        key_length = self.metadata.get(arch + '.attention.key_length', head_dim)
+        value_length = self.metadata.get(arch + '.attention.value_length', head_dim)
+        self.n_vocab = self.metadata.get('tokenizer.ggml.tokens', 0)
+        # F16 K and V of one token in one layer
+        self.kv_bytes_per_token = (key_length + value_length) * n_head_kv * 2
+
+        self.layer_bytes = [0] * self.n_layers
+        self.output_bytes = 0  # Offloaded with one layer more than the model has
+        self.other_bytes = 0
+        for name, ggml_type, size in self.tensors:
+            parts = name.split('.')
+            if parts[0] == 'blk' and parts[1].isdigit() and int(parts[1]) < self.n_layers:
+                self.layer_bytes[int(parts[1])] += size
+            elif parts[0] in ('output', 'output_norm'):
+                self.output_bytes += size
+            else:
+                self.other_bytes += size
+        self.size = sum(size for _, _, size in self.tensors)
+
+    def read(self, data, fmt):
+        value, = struct.unpack_from(fmt, data, self.pos)
+        self.pos += struct.calcsize(fmt)
+        return value
+
+    def read_string(self, data, count):
+        length = self.read(data, count)
+        self.pos += length
+        return data[self.pos - length:self.pos].decode('utf-8', errors='replace')
+
+    # Arrays come back as their length, or as a list when they hold a few numbers
+    def read_value(self, data, count, value_type):
+        if value_type == 8:
+            return self.read_string(data, count)
+        if value_type != 9:
+            return self.read(data, GGUF_SCALARS[value_type])
+        item_type = self.read(data, '<I')
+        length = self.read(data, count)
+        if item_type in GGUF_SCALARS and length <= 1024:
+            return [self.read(data, GGUF_SCALARS[item_type]) for _ in range(length)]
+        if item_type in GGUF_SCALARS:
+            self.pos += length * struct.calcsize(GGUF_SCALARS[item_type])
+        else:
+            for _ in range(length):
+                self.read_value(data, count, item_type)
+        return length
+
+    # Share of the weights in each quantization type, largest first
+    def quantization(self):
+        sizes = {}
+        for _, ggml_type, size in self.tensors:
+            type_name = GGML_TYPES.get(ggml_type, 'type %d' % ggml_type)
+            sizes[type_name] = sizes.get(type_name, 0) + size
+        return sorted(sizes.items(), key=lambda item: -item[1])
+
+    def kv_cache_bytes(self, ctx_size, layers=None):
+        return self.kv_bytes_per_token * ctx_size * (self.n_layers if layers is None else layers)
+
+    # Rough size of the compute buffers: logits and activations of a batch, and the attention scores
+    def compute_bytes(self, ctx_size, bth_size):
+        return bth_size * (self.n_embd + self.n_vocab) * 4 + bth_size * ctx_size * self.n_head * 4
+
+    # The bytes on the GPU and in RAM with gpu_layers offloaded like --n-gpu-layers does
+    def memory_use(self, gpu_layers, ctx_size, bth_size):
+        layers = min(gpu_layers, self.n_layers)
+        offloaded = sum(self.layer_bytes[self.n_layers - layers:])
+        if gpu_layers > self.n_layers:
+            offloaded += self.output_bytes
+        vram = offloaded + self.kv_cache_bytes(ctx_size, layers)
+        if gpu_layers:
+            vram += self.compute_bytes(ctx_size, bth_size) + GPU_OVERHEAD
+        ram = self.size - offloaded + self.kv_cache_bytes(ctx_size, self.n_layers - layers)
+        return vram, ram
+
+    # GPU layers and context size for a GPU memory budget, and RAM if known. Prefers offloading more layers,
+    # then a longer context, but does not shrink the context below 4096 (or the trained one) for layers.
+    def plan(self, vram_budget, ram_budget=None, bth_size=512):
+        n_ctx_train = self.n_ctx_train or 4096
+        floor = min(n_ctx_train, 4096)
+        candidates = []
+        ctx_size = n_ctx_train
+        while ctx_size > floor:
+            candidates.append(ctx_size)
+            ctx_size //= 2
+        candidates.append(floor)
+        best = None
+        for ctx_size in candidates:
+            gpu_layers = self.n_layers + 1
+            while gpu_layers > 0 and self.memory_use(gpu_layers, ctx_size, bth_size)[0] > vram_budget:
+                gpu_layers -= 1
+            if ram_budget is not None and self.memory_use(gpu_layers, ctx_size, bth_size)[1] > ram_budget:
+                continue
+            if best is None or gpu_layers > best[0]:
+                best = (gpu_layers, ctx_size)
+        return best or (0, floor)
+
+
+def physical_memory():
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def format_bytes(size):
+    return '%.1f GB' % (size / 1024 ** 3) if size >= 1024 ** 3 else '%.0f MB' % (size / 1024 ** 2)
+
+
+# The GGUF models and LoRA adapters in a set of folders, with what their headers say. The index is kept in a
+# JSON file and an entry is only read again when the size or modification time of its file changed, so a
+# rescan of unchanged files only costs a stat each.
+class ModelLibrary:
+    extensions = ('.gguf', '.bin')
+
+    def __init__(self, index_path):
+        self.index_path = index_path
+        self.lock = threading.Lock()
+        self.entries = {}
+        try:
+            with open(index_path, encoding='utf-8') as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError):
+            pass
+
+    def snapshot(self):
+        with self.lock:
+            entries = [entry for entry in self.entries.values() if entry['kind'] != 'other']
+        return sorted(entries, key=lambda entry: (entry['kind'], entry['name'].lower()))
+
+    # Runs in a thread, returns the number of files whose header had to be read
+    def scan(self, folders):
+        with self.lock:
+            old = dict(self.entries)
+        entries = {}
+        parsed = 0
+        for folder in folders:
+            for root, dirs, files in os.walk(folder):
+                dirs.sort()
+                for file_name in files:
+                    if not file_name.lower().endswith(self.extensions):
+                        continue
+                    path = os.path.join(root, file_name)
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    entry = old.get(path)
+                    if entry is None or entry['mtime'] != stat.st_mtime or entry['size'] != stat.st_size:
+                        entry = self.describe(path, stat)
+                        parsed += 1
+                    entries[path] = entry
+        with self.lock:
+            self.entries = entries
+        self.save(entries)
+        return parsed
+
+    # The index entry of a file, of kind 'other' if it is neither a GGUF file nor a GGML LoRA adapter
+    @staticmethod
+    def describe(path, stat):
+        entry = {'path': path, 'mtime': stat.st_mtime, 'size': stat.st_size, 'name': os.path.basename(path),
+                 'kind': 'model', 'architecture': '', 'quantization': '', 'layers': 0, 'context': 0}
+        try:
+            info = GGUFInfo(path)
+        except (OSError, ValueError, KeyError, struct.error):
+            # LoRA adapters from convert-lora-to-ggml.py
+            try:
+                with open(path, 'rb') as f:
+                    entry['kind'] = 'lora' if f.read(4) == b'algg' else 'other'
+            except OSError:
+                entry['kind'] = 'other'
+            return entry
+        if info.metadata.get('general.type') == 'adapter' or \
+                any(key.startswith('adapter.') for key in info.metadata) or \
+                any('lora_a' in name for name, _, _ in info.tensors[:8]):
+            entry['kind'] = 'lora'
+        entry['name'] = info.metadata.get('general.name', entry['name'])
+        entry['architecture'] = info.metadata.get('general.architecture', '')
+        entry['quantization'] = ', '.join(type_name for type_name, _ in info.quantization()[:2])
+        entry['layers'] = info.n_layers
+        entry['context'] = info.n_ctx_train
+        return entry
+
+    def save(self, entries):
+        temp_path = self.index_path + '.tmp'
+        try:
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump(entries, f)
+            os.replace(temp_path, self.index_path)
+        except OSError as e:
+            print('Cannot write the model library index:', e)
+
+
+# mmap and mincore of the C library, to see which pages of a file are in the page cache
+try:
+    LIBC = ctypes.CDLL(None, use_errno=True) if not sys.platform.startswith('win') else None
+    LIBC.mmap.restype = ctypes.c_void_p
+    LIBC.mmap.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int, ctypes.c_int, ctypes.c_int, ctypes.c_long]
+    LIBC.munmap.argtypes = [ctypes.c_void_p, ctypes.c_size_t]
+    LIBC.mincore.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_void_p]
+except (OSError, AttributeError):
+    LIBC = None
+RESIDENT_BITS = bytes(value & 1 for value in range(256))
+
+
+# One byte per page of the file, 1 if it is in the page cache, or None where that cannot be told
+def resident_pages(path):
+    if LIBC is None:
+        return None
+    size = os.path.getsize(path)
+    if size == 0:
+        return b''
+    with open(path, 'rb') as f:
+        address = LIBC.mmap(None, size, mmap.PROT_READ, mmap.MAP_SHARED, f.fileno(), 0)
+        if address is None or address == ctypes.c_void_p(-1).value:
+            return None
+        try:
+            pages = (ctypes.c_ubyte * ((size + mmap.PAGESIZE - 1) // mmap.PAGESIZE))()
+            if LIBC.mincore(address, size, ctypes.cast(pages, ctypes.c_void_p)) != 0:
+                return None
+            return bytes(pages).translate(RESIDENT_BITS)
+        finally:
+            LIBC.munmap(address, size)
+
+
+# Read files into the page cache with large sequential reads, skipping the chunks that are resident already.
+# progress(done, total, bytes per second) is called a few times a second, returns False if cancelled.
+def prewarm_files(paths, progress, cancel, chunk_size=16 * 1024 * 1024):
+    files = [(path, os.path.getsize(path), resident_pages(path)) for path in paths]
+    total = sum(size for _, size, _ in files)
+    done = 0
+    read = 0
+    buffer = bytearray(chunk_size)
+    pages_per_chunk = chunk_size // mmap.PAGESIZE
+    started = reported = time.time()
+    for path, size, pages in files:
+        with open(path, 'rb', buffering=0) as f:
+            if hasattr(os, 'posix_fadvise'):
+                os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            for chunk in range((size + chunk_size - 1) // chunk_size):
+                if cancel.is_set():
+                    return False
+                length = min(chunk_size, size - chunk * chunk_size)
+                first_page = chunk * pages_per_chunk
+                if pages is None or pages.count(0, first_page, first_page + pages_per_chunk):
+                    f.seek(chunk * chunk_size)
+                    f.readinto(buffer)
+                    read += length
+                done += length
+                now = time.time()
+                if now - reported >= 0.25:
+                    reported = now
+                    progress(done, total, read / max(now - started, 1e-6))
+    progress(total, total, read / max(time.time() - started, 1e-6))
+    return True
+
+
+# One server.cpp of the model pool. The size of the model file stands in for the memory it takes.
+class ModelProcess:
+    def __init__(self, model_path, port, runner, thread):
+        self.model_path = model_path
+        self.port = port
+        self.runner = runner
+        self.thread = thread
+        self.last_used = time.time()
+        self.size = os.path.getsize(model_path) if os.path.exists(model_path) else 0
+        # Set once evicted, while the requests it is still answering drain
+        self.stopping = False
+
+    def alive(self):
+        return self.runner.process is None or self.runner.process.poll() is None
+
+    def terminate(self):
+        if self.runner.process and self.runner.process.poll() is None:
+            self.runner.process.terminate()
+
+
 class ModelChooser(QWidget):
+    model_selected = pyqtSignal(str)
+
     def __init__(self):
         super().__init__()
 
@@ -65,6 +830,7 @@ class ModelChooser(QWidget):
         model_path, _ = file_dialog.getOpenFileName(self, 'Select Model', '', options=options)
         if model_path:
             self.model_entry.setText(model_path)
+            self.model_selected.emit(model_path)
 
 
 class LoraChooser(QWidget):
@@ -115,7 +881,189 @@ class LoraBaseChooser(QWidget):
             self.lorabase_entry.setText(lorabase_path)
 
 
+# Live view of PerfStats: throughput percentiles over the last requests, request rate and slot utilisation
+# over the last minute, refreshed every second
+class PerfDashboard(QWidget):
+    def __init__(self, stats, window=100):
+        super().__init__()
+        self.stats = stats
+        self.window = window
+        self.slot_history = deque(maxlen=60)
+
+        self.layout = QVBoxLayout()
+        self.summary_label = QLabel('No requests yet', self)
+        self.summary_label.setFont(QFontDatabase.systemFont(QFontDatabase.FixedFont))
+        self.summary_label.setAlignment(Qt.AlignTop | Qt.AlignLeft)
+        self.export_button = QPushButton('Export CSV', self)
+        self.export_button.clicked.connect(self.export_csv)
+        self.reset_button = QPushButton('Reset', self)
+        self.reset_button.clicked.connect(self.reset)
+
+        self.button_layout = QHBoxLayout()
+        self.button_layout.addWidget(self.export_button)
+        self.button_layout.addWidget(self.reset_button)
+        self.layout.addWidget(self.summary_label)
+        self.layout.addStretch()
+        self.layout.addLayout(self.button_layout)
+        self.setLayout(self.layout)
+
+        self.timer = QTimer(self)
+        self.timer.timeout.connect(self.refresh)
+        self.timer.start(1000)
+
+    def refresh(self):
+        samples = self.stats.snapshot()
+        busy, n_slots, busy_seconds, slot_seconds = self.stats.slot_use()
+        self.slot_history.append((busy_seconds, slot_seconds))
+        recent = samples[-self.window:]
+        lines = ['Requests:    %d, %.2f/s over the last minute'
+                 % (len(samples), sum(1 for sample in samples if sample['time'] > time.time() - 60) / 60)]
+        for title, field, unit in (('Prompt:', 'prompt_tokens_per_second', 'tokens/s'),
+                                   ('Generation:', 'generation_tokens_per_second', 'tokens/s'),
+                                   ('Total time:', 'total_ms', 'ms')):
+            values = [sample[field] for sample in recent if field in sample]
+            if values:
+                lines.append('%-12s p50 %8.1f  p95 %8.1f  p99 %8.1f %s' % (title, percentile(values, 50),
+                             percentile(values, 95), percentile(values, 99), unit))
+            else:
+                lines.append('%-12s -' % title)
+        if n_slots:
+            first_busy, first_total = self.slot_history[0]
+            utilisation = (busy_seconds - first_busy) / (slot_seconds - first_total) if slot_seconds > first_total \
+                else busy / n_slots
+            lines.append('Slots:       %d of %d busy, %.0f%% utilised over the last minute'
+                         % (busy, n_slots, utilisation * 100))
+        else:
+            lines.append('Slots:       -')
+        lines.append('')
+        lines.append('Percentiles of the last %d requests' % min(len(samples), self.window))
+        self.summary_label.setText('\n'.join(lines))
+
+    def reset(self):
+        self.stats.reset()
+        self.slot_history.clear()
+        self.refresh()
+
+    def export_csv(self):
+        path, _ = QFileDialog.getSaveFileName(self, 'Export Timings', 'timings.csv', 'CSV Files (*.csv)')
+        if path:
+            self.stats.write_csv(path)
+
+
+# Browse the model library: folders to scan, and a table of the indexed models and LoRA adapters. Scans run in
+# a thread, the table shows the index on disk until they finish.
+class LibraryPanel(QWidget):
+    scan_finished = pyqtSignal(int)
+    folders_changed = pyqtSignal()
+    model_chosen = pyqtSignal(str, str)  # kind, path
+
+    def __init__(self, library):
+        super().__init__()
+        self.library = library
+        self.scanning = False
+
+        self.layout = QVBoxLayout()
+        self.folder_list = QListWidget(self)
+        self.folder_list.setMaximumHeight(70)
+        self.add_folder_button = QPushButton('Add Folder', self)
+        self.add_folder_button.clicked.connect(self.add_folder)
+        self.remove_folder_button = QPushButton('Remove Folder', self)
+        self.remove_folder_button.clicked.connect(self.remove_folder)
+        self.rescan_button = QPushButton('Rescan', self)
+        self.rescan_button.clicked.connect(self.rescan)
+        self.folder_buttons_layout = QHBoxLayout()
+        self.folder_buttons_layout.addWidget(self.add_folder_button)
+        self.folder_buttons_layout.addWidget(self.remove_folder_button)
+        self.folder_buttons_layout.addWidget(self.rescan_button)
+
+        self.filter_entry = QLineEdit(self)
+        self.filter_entry.setPlaceholderText('Filter...')
+        self.filter_entry.textChanged.connect(self.refresh)
+        self.table = QTableWidget(0, 6, self)
+        self.table.setHorizontalHeaderLabels(['Name', 'Type', 'Quantization', 'Layers', 'Context', 'Size'])
+        self.table.horizontalHeader().setSectionResizeMode(0, QHeaderView.Stretch)
+        self.table.setSelectionBehavior(QAbstractItemView.SelectRows)
+        self.table.setEditTriggers(QAbstractItemView.NoEditTriggers)
+        self.table.cellDoubleClicked.connect(self.use_selected)
+        self.use_button = QPushButton('Use Selected', self)
+        self.use_button.clicked.connect(self.use_selected)
+        self.status_label = QLabel('', self)
+
+        self.layout.addWidget(self.folder_list)
+        self.layout.addLayout(self.folder_buttons_layout)
+        self.layout.addWidget(self.filter_entry)
+        self.layout.addWidget(self.table)
+        self.layout.addWidget(self.status_label)
+        self.layout.addWidget(self.use_button)
+        self.setLayout(self.layout)
+
+        self.scan_finished.connect(self.on_scan_finished)
+        self.refresh()
+
+    def folders(self):
+        return [self.folder_list.item(row).text() for row in range(self.folder_list.count())]
+
+    def set_folders(self, folders):
+        self.folder_list.clear()
+        self.folder_list.addItems(folders)
+
+    def add_folder(self):
+        folder = QFileDialog.getExistingDirectory(self, 'Add Model Folder')
+        if folder and folder not in self.folders():
+            self.folder_list.addItem(folder)
+            self.folders_changed.emit()
+            self.rescan()
+
+    def remove_folder(self):
+        for item in self.folder_list.selectedItems():
+            self.folder_list.takeItem(self.folder_list.row(item))
+        self.folders_changed.emit()
+        self.rescan()
+
+    def rescan(self):
+        if self.scanning:
+            return
+        self.scanning = True
+        self.status_label.setText('Scanning...')
+        folders = self.folders()
+        threading.Thread(target=lambda: self.scan_finished.emit(self.library.scan(folders)), daemon=True).start()
+
+    def on_scan_finished(self, parsed):
+        self.scanning = False
+        self.refresh()
+        self.status_label.setText('%d files, %d new or changed' % (self.table.rowCount(), parsed))
+
+    def refresh(self):
+        text = self.filter_entry.text().lower()
+        entries = [entry for entry in self.library.snapshot()
+                   if text in entry['name'].lower() or text in entry['path'].lower()]
+        self.table.setRowCount(len(entries))
+        for row, entry in enumerate(entries):
+            values = [entry['name'], 'LoRA' if entry['kind'] == 'lora' else entry['architecture'],
+                      entry['quantization'], str(entry['layers'] or ''), str(entry['context'] or ''),
+                      format_bytes(entry['size'])]
+            for column, value in enumerate(values):
+                item = QTableWidgetItem(value)
+                item.setToolTip(entry['path'])
+                item.setData(Qt.UserRole, (entry['kind'], entry['path']))
+                self.table.setItem(row, column, item)
+
+    def use_selected(self, *args):
+        item = self.table.item(self.table.currentRow(), 0)
+        if item is not None:
+            self.model_chosen.emit(*item.data(Qt.UserRole))
+
+
 class LlamaServerWrapper(QMainWindow):
+    # Emitted from the threads waiting for a server.cpp to load its model, with the load time in seconds
+    server_ready = pyqtSignal(str, float)
+    model_switched = pyqtSignal(str, float)
+    model_switch_failed = pyqtSignal(str, str)
+    tune_progress = pyqtSignal(str)
+    prewarm_progress = pyqtSignal(str)
+    prewarm_finished = pyqtSignal(str, bool)
+    tune_finished = pyqtSignal(str, object)
+
     # Check the operating system
     if sys.platform.startswith('win'):
         # Windows: Create the folder in AppData\Roaming
@@ -134,8 +1082,26 @@ class LlamaServerWrapper(QMainWindow):
         super().__init__()
         self.initUI()
         self.server_runner = None
+        self.server_runner_thread = None
         self.api_process = None
+        # server.cpp processes by model path, the active one and warm standbys
+        self.model_processes = {}
+        self.active_model = None
+        self.switching = False
+        # Lets the launcher repoint the OpenAI wrapper to another server.cpp
+        self.admin_key = secrets.token_hex(16)
+        self.server_ready.connect(self.on_server_ready)
+        self.model_switched.connect(self.on_model_switched)
+        self.model_switch_failed.connect(self.on_model_switch_failed)
+        self.tune_progress.connect(self.tune_status.setText)
+        self.prewarm_progress.connect(self.status_label.setText)
+        self.prewarm_finished.connect(self.on_prewarm_finished)
+        self.prewarm_cancel = None
+        self.tune_finished.connect(self.on_tune_finished)
         self.load_settings()  # Load saved settings when the application starts
+        self.inspect_model()
+        self.library_tab.set_folders(self.library_folders())
+        self.library_tab.rescan()
 
     def initUI(self):
         self.setWindowTitle('LLama.cpp QT')
@@ -146,10 +1112,20 @@ class LlamaServerWrapper(QMainWindow):
         self.model_tab = QWidget()
         self.lora_tab = QWidget()
         self.server_tab = QWidget()
+        # Timings of the served requests, shown while a model is loaded
+        self.perf_stats = PerfStats()
+        self.perf_tab = PerfDashboard(self.perf_stats)
+        # Models and LoRA adapters found in the library folders
+        self.library_tab = LibraryPanel(ModelLibrary(os.path.join(self.config_dir, "library.json")))
+        self.library_tab.model_chosen.connect(self.use_library_model)
+        self.library_tab.folders_changed.connect(self.save_library_folders)
 
         self.tab_widget.addTab(self.model_tab, "Model Settings")
         self.tab_widget.addTab(self.lora_tab, "Lora Settings")
         self.tab_widget.addTab(self.server_tab, "Server Settings")
+        self.tab_widget.addTab(self.perf_tab, "Performance")
+        self.tab_widget.setTabVisible(3, 0)
+        self.tab_widget.addTab(self.library_tab, "Model Library")
 
         self.setCentralWidget(self.tab_widget)
         self.tab_widget.tabBarClicked.connect(self.handle_tabbar_clicked)
@@ -161,14 +1137,45 @@ class LlamaServerWrapper(QMainWindow):
 
         self.model_chooser = ModelChooser()
         self.model_chooser.layout.setAlignment(Qt.AlignTop)
+        self.model_chooser.model_selected.connect(self.fit_model_settings)
+        self.model_chooser.model_entry.editingFinished.connect(self.inspect_model)
 
         self.model_settings_layout.addWidget(self.model_chooser)
 
+        # What the GGUF header says about the model, and the settings that fit it into the GPU budget
+        self.model_info = None
+        self.model_info_label = QLabel('', self)
+        self.model_info_label.setWordWrap(True)
+        self.model_settings_layout.addWidget(self.model_info_label)
+
+        self.row0_layout = QHBoxLayout()  # Create a QHBoxLayout for the GPU memory budget
+        self.gpu_budget_label = QLabel('GPU Memory in GB (0 for CPU only):', self)
+        self.gpu_budget_entry = QSpinBox(self)
+        self.gpu_budget_entry.setMinimum(0)
+        self.gpu_budget_entry.setMaximum(1024)
+        self.gpu_budget_entry.setValue(0)
+        self.fit_button = QPushButton('Fit Settings to Model', self)
+        self.fit_button.clicked.connect(lambda: self.fit_model_settings(self.model_chooser.model_entry.text()))
+        self.row0_layout.addWidget(self.gpu_budget_label)
+        self.row0_layout.addWidget(self.gpu_budget_entry)
+        self.row0_layout.addWidget(self.fit_button)
+        self.model_settings_layout.addLayout(self.row0_layout)
+
+        # Measure server.cpp over a sweep of threads, batch sizes and GPU layers and keep the fastest
+        self.tune_cancel = None
+        self.tune_layout = QHBoxLayout()
+        self.tune_button = QPushButton('Auto-tune', self)
+        self.tune_button.clicked.connect(self.auto_tune)
+        self.tune_status = QLabel('', self)
+        self.tune_layout.addWidget(self.tune_button)
+        self.tune_layout.addWidget(self.tune_status, 1)
+        self.model_settings_layout.addLayout(self.tune_layout)
+
         self.row1_layout = QHBoxLayout()  # Create a QHBoxLayout for GPU Layers
         self.gpu_layers_label = QLabel('GPU Layers:', self)
         self.gpu_layers_entry = QSpinBox(self)
-        self.gpu_layers_entry.setMinimum(1)
-        self.gpu_layers_entry.setMaximum(100)
+        self.gpu_layers_entry.setMinimum(0)
+        self.gpu_layers_entry.setMaximum(1000)
         self.row1_layout.addWidget(self.gpu_layers_label)
         self.row1_layout.addWidget(self.gpu_layers_entry)
         self.model_settings_layout.addLayout(self.row1_layout)
@@ -186,7 +1193,7 @@ class LlamaServerWrapper(QMainWindow):
         self.ctx_size_label = QLabel('Context Size:', self)
         self.ctx_size_entry = QSpinBox(self)
         self.ctx_size_entry.setMinimum(1)
-        self.ctx_size_entry.setMaximum(10000)
+        self.ctx_size_entry.setMaximum(1048576)
         self.row3_layout.addWidget(self.ctx_size_label)
         self.row3_layout.addWidget(self.ctx_size_entry)
         self.model_settings_layout.addLayout(self.row3_layout)
@@ -195,7 +1202,7 @@ class LlamaServerWrapper(QMainWindow):
         self.bth_size_label = QLabel('Batch Size:', self)
         self.bth_size_entry = QSpinBox(self)
         self.bth_size_entry.setMinimum(1)
-        self.bth_size_entry.setMaximum(10000)
+        self.bth_size_entry.setMaximum(1048576)
         self.row4_layout.addWidget(self.bth_size_label)
         self.row4_layout.addWidget(self.bth_size_entry)
         self.model_settings_layout.addLayout(self.row4_layout)
@@ -212,6 +1219,12 @@ class LlamaServerWrapper(QMainWindow):
         self.row6_layout.addWidget(self.lowvram_checkbox)
         self.model_settings_layout.addLayout(self.row6_layout)
 
+        # Checkbox for reading the model into the page cache before server.cpp loads it
+        self.row7_layout = QHBoxLayout()  # Create a QHBoxLayout for prewarm
+        self.prewarm_checkbox = QCheckBox('Prewarm (read the model into the file cache before loading)', self)
+        self.row7_layout.addWidget(self.prewarm_checkbox)
+        self.model_settings_layout.addLayout(self.row7_layout)
+
         # Add stretch to push all content to the top and leave any remaining space at the bottom
         self.model_settings_layout.addStretch()
 
@@ -268,9 +1281,69 @@ class LlamaServerWrapper(QMainWindow):
         self.oaiport_entry.setMaximum(65535)
         self.oaiport_entry.setValue(8089)  # Set default port value
 
+        # Memory for idle models kept loaded to switch back to them instantly
+        self.model_budget_label = QLabel('Warm Model Budget in GB (0 keeps only the active model):', self)
+        self.model_budget_entry = QSpinBox(self)
+        self.model_budget_entry.setMinimum(0)
+        self.model_budget_entry.setMaximum(4096)
+        self.model_budget_entry.setValue(0)
+
         self.server_settings_layout.addWidget(self.oai_checkbox)
         self.server_settings_layout.addWidget(self.oaiport_label)
         self.server_settings_layout.addWidget(self.oaiport_entry)
+        self.server_settings_layout.addWidget(self.model_budget_label)
+        self.server_settings_layout.addWidget(self.model_budget_entry)
+
+        # Checkbox for keeping the output in a rotating log file
+        self.log_file_checkbox = QCheckBox('Write server output to a log file (server.log in the config folder)', self)
+        self.server_settings_layout.addWidget(self.log_file_checkbox)
+
+        # Launch profile: the CPUs or NUMA node server.cpp runs on, and its CPU and I/O priority
+        self.cpu_topology = cpu_topology()
+        self.placement_widget = QWidget(self)
+        self.placement_layout = QVBoxLayout()
+        self.placement_layout.setContentsMargins(0, 0, 0, 0)
+        self.placement_row = QHBoxLayout()
+        self.placement_label = QLabel('CPU Placement:', self)
+        self.placement_chooser = QComboBox(self)
+        self.placement_chooser.addItem('Any CPU', 'any')
+        for node, (cpus, cores) in self.cpu_topology.items():
+            self.placement_chooser.addItem('NUMA node %d: CPUs %s, %d cores' % (node, format_cpulist(cpus), cores),
+                                           node)
+        self.placement_chooser.addItem('CPU list', 'custom')
+        self.placement_chooser.currentIndexChanged.connect(self.on_placement_changed)
+        self.cpu_list_entry = QLineEdit(self)
+        self.cpu_list_entry.setPlaceholderText('e.g. 0-7,16-23')
+        self.cpu_list_entry.setEnabled(False)
+        self.placement_row.addWidget(self.placement_label)
+        self.placement_row.addWidget(self.placement_chooser, 1)
+        self.placement_row.addWidget(self.cpu_list_entry)
+        self.membind_checkbox = QCheckBox('Allocate memory on the NUMA node only (needs numactl)', self)
+        self.membind_checkbox.setEnabled(False)
+        self.priority_row = QHBoxLayout()
+        self.nice_label = QLabel('Nice (0-19):', self)
+        self.nice_entry = QSpinBox(self)
+        self.nice_entry.setMinimum(0)
+        self.nice_entry.setMaximum(19)
+        self.io_priority_label = QLabel('I/O Priority:', self)
+        self.io_priority_chooser = QComboBox(self)
+        self.io_priority_chooser.addItem('Normal', 0)
+        self.io_priority_chooser.addItem('Low', 2)
+        self.io_priority_chooser.addItem('Idle', 3)
+        self.priority_row.addWidget(self.nice_label)
+        self.priority_row.addWidget(self.nice_entry)
+        self.priority_row.addWidget(self.io_priority_label)
+        self.priority_row.addWidget(self.io_priority_chooser)
+        self.pin_wrapper_checkbox = QCheckBox('Run the OpenAI wrapper with the same profile', self)
+        self.placement_layout.addLayout(self.placement_row)
+        self.placement_layout.addWidget(self.membind_checkbox)
+        self.placement_layout.addLayout(self.priority_row)
+        self.placement_layout.addWidget(self.pin_wrapper_checkbox)
+        self.placement_widget.setLayout(self.placement_layout)
+        # Pinning and priorities are set with Linux interfaces
+        if not hasattr(os, 'sched_setaffinity'):
+            self.placement_widget.setEnabled(False)
+        self.server_settings_layout.addWidget(self.placement_widget)
 
         # Add stretch to push all content to the top and leave any remaining space at the bottom
         self.server_settings_layout.addStretch()
@@ -280,12 +1353,31 @@ class LlamaServerWrapper(QMainWindow):
         self.output_text = QPlainTextEdit(self)
         self.output_text.setReadOnly(True)
         self.output_text.hide()
+        self.log = LogPipeline(self.output_text)
 
         self.stop_button = QPushButton('Unload Model', self)
         self.stop_button.hide()
         self.stop_button.clicked.connect(self.stop_server)
 
+        # Switch the served model through the OpenAI wrapper. The next model loads in a standby server.cpp
+        # while the current one keeps serving, then the wrapper is pointed at it.
+        self.switch_chooser = ModelChooser()
+        self.switch_chooser.hide()
+        self.switch_button = QPushButton('Switch Model', self)
+        self.switch_button.hide()
+        self.switch_button.clicked.connect(self.switch_model)
+        self.switch_status = QLabel('', self)
+        self.switch_status.hide()
+
+        # Loading or ready state of the served model
+        self.status_label = QLabel('', self)
+        self.status_label.hide()
+
+        self.model_layout.addWidget(self.status_label)
         self.model_layout.addWidget(self.output_text)
+        self.model_layout.addWidget(self.switch_chooser)
+        self.model_layout.addWidget(self.switch_status)
+        self.model_layout.addWidget(self.switch_button)
         self.model_layout.addWidget(self.stop_button)
 
         self.start_button = QPushButton('Load Model', self)
@@ -295,6 +1387,117 @@ class LlamaServerWrapper(QMainWindow):
 
         self.show()
 
+    def use_library_model(self, kind, path):
+        if kind == 'lora':
+            self.lora_chooser.lora_entry.setText(path)
+            self.tab_widget.setCurrentIndex(1)
+        else:
+            self.model_chooser.model_entry.setText(path)
+            self.fit_model_settings(path)
+            self.tab_widget.setCurrentIndex(0)
+
+    # Read the GGUF header of the model and describe it, returns the GGUFInfo or None
+    def inspect_model(self):
+        model_path = self.model_chooser.model_entry.text()
+        if self.model_info is not None and self.model_info.path == model_path:
+            return self.model_info
+        self.model_info = None
+        self.model_info_label.setText('')
+        if not model_path or not os.path.isfile(model_path):
+            return None
+        try:
+            info = GGUFInfo(model_path)
+        except (OSError, ValueError, KeyError, struct.error) as e:
+            self.model_info_label.setText('Cannot read the model header: %s' % e)
+            return None
+        quantization = ', '.join('%s %.0f%%' % (type_name, size * 100 / info.size)
+                                 for type_name, size in info.quantization()[:3])
+        self.model_info_label.setText('%s: %d layers, %s (%s), trained context %d, KV cache %s per 1000 tokens'
+                                      % (info.name, info.n_layers, format_bytes(info.size), quantization,
+                                         info.n_ctx_train, format_bytes(info.kv_cache_bytes(1000))))
+        self.model_info = info
+        return info
+
+    # Pre-fill GPU layers, context and batch size that fit the model into the GPU memory budget
+    def fit_model_settings(self, model_path):
+        info = self.inspect_model()
+        if info is None or not info.n_layers:
+            return
+        bth_size = min(512, info.n_ctx_train or 512)
+        vram_budget = self.gpu_budget_entry.value() * 1024 ** 3
+        gpu_layers, ctx_size = info.plan(vram_budget, physical_memory(), bth_size)
+        tuned = self.tuned_settings(info.path)
+        if tuned is not None:
+            # Settings auto-tune found fastest on this host win over the estimate
+            gpu_layers = tuned["--n-gpu-layers"]
+            bth_size = min(tuned["--batch-size"], ctx_size)
+            self.threads_entry.setValue(tuned["--threads"])
+        self.gpu_layers_entry.setValue(gpu_layers)
+        self.ctx_size_entry.setValue(ctx_size)
+        self.bth_size_entry.setValue(bth_size)
+        vram, ram = info.memory_use(gpu_layers, ctx_size, bth_size)
+        self.model_info_label.setText(self.model_info_label.text().split('\n')[0] +
+                                      '\nEstimated with %d of %d layers offloaded: %s GPU memory, %s RAM%s'
+                                      % (min(gpu_layers, info.n_layers), info.n_layers, format_bytes(vram),
+                                         format_bytes(ram), ' (auto-tuned)' if tuned is not None else ''))
+
+    # Sweep threads, then batch size, then GPU layers with the other settings as they are, or stop a sweep
+    def auto_tune(self):
+        if self.tune_cancel is not None:
+            self.tune_cancel.set()
+            self.tune_status.setText('Stopping...')
+            return
+        model_path = self.model_chooser.model_entry.text()
+        if not model_path:
+            return
+        ctx_size = self.ctx_size_entry.value()
+        profile = self.launch_profile()
+        cpus = len(profile.cpus) if profile.cpus else os.cpu_count() or 4
+        threads = sorted({max(1, cpus // 4), max(1, cpus // 2), max(1, cpus * 3 // 4), cpus,
+                          self.threads_entry.value()})
+        bth_sizes = sorted({size for size in (128, 256, 512, 1024, 2048) if size <= ctx_size} |
+                           {self.bth_size_entry.value()})
+        gpu_layers = {self.gpu_layers_entry.value()}
+        info = self.inspect_model()
+        if info is not None and info.n_layers and self.gpu_budget_entry.value():
+            planned, _ = info.plan(self.gpu_budget_entry.value() * 1024 ** 3, physical_memory(), 512)
+            gpu_layers |= {planned, max(0, planned - 4), max(0, planned - 8)}
+        sweeps = [("--threads", threads), ("--batch-size", bth_sizes), ("--n-gpu-layers", sorted(gpu_layers))]
+        start = {"--threads": self.threads_entry.value(), "--batch-size": self.bth_size_entry.value(),
+                 "--n-gpu-layers": self.gpu_layers_entry.value()}
+        port = self.free_server_port()
+        base_cmd = self.build_server_cmd(model_path, port)
+        url = "http://" + self.host_entry.text() + ":" + str(port)
+
+        self.tune_cancel = threading.Event()
+        self.tune_button.setText('Stop Auto-tune')
+        self.start_button.setEnabled(False)
+        self.fit_button.setEnabled(False)
+        cancel = self.tune_cancel
+
+        def run():
+            best = tune_server(base_cmd, url, start, sweeps, self.tune_progress.emit, cancel, profile)
+            self.tune_finished.emit(model_path, best)
+
+        threading.Thread(target=run, daemon=True).start()
+
+    def on_tune_finished(self, model_path, best):
+        cancelled = self.tune_cancel.is_set()
+        self.tune_cancel = None
+        self.tune_button.setText('Auto-tune')
+        self.start_button.setEnabled(True)
+        self.fit_button.setEnabled(True)
+        if best is None:
+            self.tune_status.setText('Auto-tune stopped' if cancelled else 'Auto-tune failed, no setting loaded')
+            return
+        self.threads_entry.setValue(best["--threads"])
+        self.bth_size_entry.setValue(best["--batch-size"])
+        self.gpu_layers_entry.setValue(best["--n-gpu-layers"])
+        self.record_tuned_settings(model_path, best)
+        self.tune_status.setText('Best: %d threads, batch %d, %d GPU layers (prompt %.1f, generation %.1f tokens/s)'
+                                 % (best["--threads"], best["--batch-size"], best["--n-gpu-layers"],
+                                    best["prompt_tps"], best["gen_tps"]))
+
     def start_server(self):
         model_path = self.model_chooser.model_entry.text()
         gpu_layers = str(self.gpu_layers_entry.value())
@@ -312,6 +1515,138 @@ class LlamaServerWrapper(QMainWindow):
         if not model_path:
             return
 
+        self.save_settings(model_path, gpu_layers, threads, ctx_size, bth_size, mlock, lowvram, lora_path,
+                           lorabase_path, host, port, oaiport)
+
+        log_file = os.path.join(self.config_dir, "server.log") if self.log_file_checkbox.isChecked() else None
+        self.log.set_log_file(log_file)
+        self.perf_stats.reset()
+
+        self.save_model_tab = self.tab_widget.widget(0)
+        self.save_lora_tab = self.tab_widget.widget(1)
+        self.save_server_tab = self.tab_widget.widget(2)
+        self.tab_widget.removeTab(0)
+        self.tab_widget.insertTab(0, self.save_model_tab, 'Server Output')
+        self.tab_widget.setTabVisible(1, 0)
+        self.tab_widget.setTabVisible(2, 0)
+        self.tab_widget.setTabVisible(3, 1)
+        self.tab_widget.setTabVisible(4, 0)
+        self.model_chooser.hide()
+        self.model_info_label.hide()
+        self.gpu_budget_label.hide()
+        self.gpu_budget_entry.hide()
+        self.fit_button.hide()
+        self.tune_button.hide()
+        self.tune_status.hide()
+        self.gpu_layers_label.hide()
+        self.gpu_layers_entry.hide()
+        self.threads_label.hide()
+        self.threads_entry.hide()
+        self.ctx_size_label.hide()
+        self.ctx_size_entry.hide()
+        self.bth_size_label.hide()
+        self.bth_size_entry.hide()
+        self.mlock_checkbox.hide()
+        self.lowvram_checkbox.hide()
+        self.prewarm_checkbox.hide()
+        self.host_label.hide()
+        self.host_entry.hide()
+        self.port_label.hide()
+        self.port_entry.hide()
+        self.oaiport_label.hide()
+        self.oaiport_entry.hide()
+        self.start_button.hide()
+        self.oai_checkbox.hide()
+        self.model_budget_label.hide()
+        self.model_budget_entry.hide()
+        self.log_file_checkbox.hide()
+        self.placement_widget.hide()
+        self.output_text.show()
+        self.stop_button.show()
+        self.status_label.show()
+
+        if self.prewarm_checkbox.isChecked():
+            self.prewarm(model_path, [path for path in (model_path, lora_path, lorabase_path) if path])
+        else:
+            self.launch_model(model_path)
+
+    def launch_model(self, model_path):
+        process = self.start_model_process(model_path, self.port_entry.value())
+        self.server_runner = process.runner
+        self.server_runner_thread = process.thread
+        self.active_model = model_path
+
+        last_load_time = self.load_time(model_path)
+        status = 'Loading ' + os.path.basename(model_path) + '...'
+        if last_load_time is not None:
+            status += ' (last load took %.1f s)' % last_load_time
+        self.status_label.setText(status)
+
+        # Start the oai_api.py script once the model is loaded
+        threading.Thread(target=self.wait_until_ready, args=(process, self.host_entry.text())).start()
+
+    # Read the model and LoRA files into the page cache in a thread, then launch server.cpp
+    def prewarm(self, model_path, paths):
+        paths = [path for path in paths if os.path.isfile(path)]
+        memory = physical_memory()
+        if memory is not None and sum(os.path.getsize(path) for path in paths) > memory * 0.9:
+            # The end of the files would push their start out of the cache again
+            self.log.write('Not prewarming, the model files do not fit into memory')
+            self.launch_model(model_path)
+            return
+        self.prewarm_cancel = cancel = threading.Event()
+        self.status_label.setText('Prewarming ' + os.path.basename(model_path) + '...')
+
+        def progress(done, total, speed):
+            self.prewarm_progress.emit('Prewarming %s: %s of %s (%.0f%%), reading %s/s'
+                                       % (os.path.basename(model_path), format_bytes(done), format_bytes(total),
+                                          done * 100 / max(total, 1), format_bytes(speed)))
+
+        def run():
+            try:
+                completed = prewarm_files(paths, progress, cancel)
+            except OSError as e:
+                self.log.write('Prewarming failed: %s' % e)
+                completed = not cancel.is_set()
+            self.prewarm_finished.emit(model_path, completed)
+
+        threading.Thread(target=run, daemon=True).start()
+
+    def on_prewarm_finished(self, model_path, completed):
+        self.prewarm_cancel = None
+        if completed:
+            self.launch_model(model_path)
+        else:
+            self.on_server_stopped()
+
+    # Runs in a thread: wait for server.cpp to load the model
+    def wait_until_ready(self, process, host):
+        url = "http://" + host + ":" + str(process.port)
+        if wait_for_server(url, alive=process.alive, listening=process.runner.listening):
+            self.server_ready.emit(process.model_path, time.time() - process.runner.started_at)
+
+    def on_server_ready(self, model_path, load_time):
+        if model_path != self.active_model:
+            return
+        self.record_load_time(model_path, load_time)
+        self.status_label.setText('Ready: %s loaded in %.1f s' % (os.path.basename(model_path), load_time))
+        if self.oai_checkbox.isChecked():
+            api_thread = threading.Thread(target=self.start_api_script)
+            api_thread.start()
+            self.switch_chooser.model_entry.setText(model_path)
+            self.switch_status.setText('Serving ' + os.path.basename(model_path))
+            self.switch_chooser.show()
+            self.switch_status.show()
+            self.switch_button.show()
+
+    def build_server_cmd(self, model_path, port):
+        gpu_layers = str(self.gpu_layers_entry.value())
+        threads = str(self.threads_entry.value())
+        ctx_size = str(self.ctx_size_entry.value())
+        bth_size = str(self.bth_size_entry.value())
+        host = self.host_entry.text()
+        port = str(port)
+
         if platform.system() == "Windows":
             # On Windows, execute server.exe
             cmd = [
@@ -353,55 +1688,136 @@ class LlamaServerWrapper(QMainWindow):
             cmd.append("--lora-base")
             cmd.append(self.lorabase_chooser.lorabase_entry.text())  # Append the lorabase_path value
 
-        self.save_settings(model_path, gpu_layers, threads, ctx_size, bth_size, mlock, lowvram, lora_path,
-                           lorabase_path, host, port, oaiport)
-
-        self.server_runner = ServerRunner(cmd)
-        self.server_runner.started.connect(self.on_server_started)
-        self.server_runner.stopped.connect(self.on_server_stopped)
-        self.server_runner.output_received.connect(self.on_output_received)
-
-        self.server_runner_thread = threading.Thread(target=self.server_runner.run_server)
-        self.server_runner_thread.start()
-
-        self.save_model_tab = self.tab_widget.widget(0)
-        self.save_lora_tab = self.tab_widget.widget(1)
-        self.save_server_tab = self.tab_widget.widget(2)
-        self.tab_widget.removeTab(0)
-        self.tab_widget.insertTab(0, self.save_model_tab, 'Server Output')
-        self.tab_widget.setTabVisible(1, 0)
-        self.tab_widget.setTabVisible(2, 0)
-        self.model_chooser.hide()
-        self.gpu_layers_label.hide()
-        self.gpu_layers_entry.hide()
-        self.threads_label.hide()
-        self.threads_entry.hide()
-        self.ctx_size_label.hide()
-        self.ctx_size_entry.hide()
-        self.bth_size_label.hide()
-        self.bth_size_entry.hide()
-        self.mlock_checkbox.hide()
-        self.lowvram_checkbox.hide()
-        self.host_label.hide()
-        self.host_entry.hide()
-        self.port_label.hide()
-        self.port_entry.hide()
-        self.oaiport_label.hide()
-        self.oaiport_entry.hide()
-        self.start_button.hide()
-        self.oai_checkbox.hide()
-        self.output_text.show()
-        self.stop_button.show()
-
-        # Start the oai_api.py script in a separate thread with a delay
-        if self.oai_checkbox.isChecked():
-            api_thread = threading.Thread(target=self.start_api_script_with_delay)
-            api_thread.start()
+        # Run another server binary, like the mock of bench_oai_api.py, instead
+        if os.environ.get("LLAMA_SERVER"):
+            cmd[0:1] = shlex.split(os.environ["LLAMA_SERVER"], posix=platform.system() != "Windows")
+
+        return cmd
+
+    # Start a server.cpp for a model and add it to the model pool
+    def start_model_process(self, model_path, port):
+        runner = ServerRunner(self.build_server_cmd(model_path, port), self.log, self.perf_stats,
+                              os.path.basename(model_path), self.launch_profile())
+        runner.started.connect(self.on_server_started)
+        runner.stopped.connect(lambda: self.on_runner_stopped(runner))
+        thread = threading.Thread(target=runner.run_server)
+        process = ModelProcess(model_path, port, runner, thread)
+        self.model_processes[model_path] = process
+        thread.start()
+        return process
+
+    def free_server_port(self):
+        used = {process.port for process in self.model_processes.values()} | {self.oaiport_entry.value()}
+        port = self.port_entry.value() + 1
+        while True:
+            if port not in used:
+                with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+                    try:
+                        sock.bind(("", port))
+                        return port
+                    except OSError:
+                        pass
+            port += 1
+
+    def switch_model(self):
+        model_path = self.switch_chooser.model_entry.text()
+        if not model_path or self.switching or model_path == self.active_model:
+            return
+        self.switching = True
+        self.switch_button.setEnabled(False)
+        process = self.model_processes.get(model_path)
+        if process is None:
+            process = self.start_model_process(model_path, self.free_server_port())
+            status = 'Loading ' + os.path.basename(model_path) + ' on port ' + str(process.port)
+            last_load_time = self.load_time(model_path)
+            if last_load_time is not None:
+                status += ' (last load took %.1f s)' % last_load_time
+            self.switch_status.setText(status)
+        host = self.host_entry.text()
+        oaiport = str(self.oaiport_entry.value())
+        threading.Thread(target=self.flip_when_ready, args=(process, host, oaiport)).start()
 
-    def start_api_script_with_delay(self):
-        # Delay for a specified time (in seconds) before starting the API script
-        api_delay = 10  # Set the delay time in seconds (adjust as needed)
-        time.sleep(api_delay)
+    # Runs in a thread: wait for the standby server.cpp to finish loading, then point the wrapper at it
+    def flip_when_ready(self, process, host, oaiport):
+        url = "http://" + host + ":" + str(process.port)
+        if not wait_for_server(url, alive=process.alive, listening=process.runner.listening):
+            self.model_switch_failed.emit(process.model_path, "server.cpp did not start")
+            return
+        load_time = time.time() - process.runner.started_at
+        try:
+            post_json("http://" + host + ":" + oaiport + "/admin/backends", {"backends": [url]}, self.admin_key)
+        except (OSError, ValueError) as e:
+            self.model_switch_failed.emit(process.model_path, str(e))
+            return
+        self.model_switched.emit(process.model_path, load_time)
+
+    def on_model_switched(self, model_path, load_time):
+        self.switching = False
+        self.switch_button.setEnabled(True)
+        process = self.model_processes.get(model_path)
+        if process is None:
+            self.switch_status.setText('Switch failed: server.cpp exited')
+            return
+        previous = self.model_processes.get(self.active_model)
+        if previous is not None:
+            previous.last_used = time.time()
+        self.server_runner = process.runner
+        self.server_runner_thread = process.thread
+        self.active_model = model_path
+        process.last_used = time.time()
+        self.switch_status.setText('Serving ' + os.path.basename(model_path))
+        self.status_label.setText('Ready: %s loaded in %.1f s' % (os.path.basename(model_path), load_time))
+        self.record_load_time(model_path, load_time)
+        self.evict_models()
+
+    def on_model_switch_failed(self, model_path, reason):
+        self.switching = False
+        self.switch_button.setEnabled(True)
+        self.switch_status.setText('Switch to ' + os.path.basename(model_path) + ' failed: ' + reason)
+        process = self.model_processes.get(model_path)
+        if process is not None and model_path != self.active_model:
+            process.terminate()
+
+    # Keep idle models loaded while all models fit into the budget, stopping the least recently used first
+    def evict_models(self):
+        budget = self.model_budget_entry.value() * 1024 ** 3
+        processes = [process for process in self.model_processes.values() if not process.stopping]
+        total = sum(process.size for process in processes)
+        idle = sorted((process for process in processes if process.runner is not self.server_runner),
+                      key=lambda process: process.last_used)
+        host = self.host_entry.text()
+        oaiport = str(self.oaiport_entry.value())
+        for process in idle:
+            if total <= budget:
+                break
+            total -= process.size
+            process.stopping = True
+            threading.Thread(target=self.stop_when_drained, args=(process, host, oaiport)).start()
+
+    # Runs in a thread: a server.cpp that was just switched away from may still be streaming answers, so
+    # wait until the wrapper reports no outstanding requests for it, or DRAIN_GRACE seconds, then stop it
+    def stop_when_drained(self, process, host, oaiport):
+        url = "http://" + host + ":" + str(process.port)
+        deadline = time.time() + DRAIN_GRACE
+        while time.time() < deadline and process.alive():
+            try:
+                backends = get_json("http://" + host + ":" + oaiport + "/admin/backends", self.admin_key)["backends"]
+            except (OSError, ValueError, KeyError):
+                break
+            if not any(backend["url"] == url and backend["outstanding"] for backend in backends):
+                break
+            time.sleep(0.5)
+        process.terminate()
+
+    def on_runner_stopped(self, runner):
+        self.perf_stats.forget(runner.name)
+        for model_path, process in list(self.model_processes.items()):
+            if process.runner is runner:
+                del self.model_processes[model_path]
+        if runner is self.server_runner:
+            self.on_server_stopped()
+
+    def start_api_script(self):
         host = self.host_entry.text()
         port = str(self.port_entry.value())
         oaiport = str(self.oaiport_entry.value())
@@ -416,7 +1832,7 @@ class LlamaServerWrapper(QMainWindow):
                 # Construct the command to activate the venv and run the script
                 command = [venv_activate, "&&", venv_python, "oai_api.py", "--host", host, "--port", oaiport,
                            "--llama-api",
-                           "http://" + host + ":" + port]
+                           "http://" + host + ":" + port, "--admin-key", self.admin_key]
             else:
                 # If it's not a bundle but on Windows, construct the path to the venv activate script
                 venv_activate = os.path.join("venv", "Scripts", "activate.bat")
@@ -424,7 +1840,7 @@ class LlamaServerWrapper(QMainWindow):
                 # Construct the command to activate the venv and run the script
                 command = [venv_activate, "&&", "python", "oai_api.py", "--host", host, "--port", oaiport,
                            "--llama-api",
-                           "http://" + host + ":" + port]
+                           "http://" + host + ":" + port, "--admin-key", self.admin_key]
 
                 self.api_process = subprocess.Popen(
                     command,
@@ -445,9 +1861,11 @@ class LlamaServerWrapper(QMainWindow):
                 else:
                     # If venv doesn't exist in the current or home directory, use the system's Python
                     venv_python = "python3"
+            command = [venv_python, "oai_api.py", "--host", host, "--port", oaiport, "--llama-api",
+                       "http://" + host + ":" + port, "--admin-key", self.admin_key]
+            profile = self.launch_profile() if self.pin_wrapper_checkbox.isChecked() else None
             self.api_process = subprocess.Popen(
-                [venv_python, "oai_api.py", "--host", host, "--port", oaiport, "--llama-api",
-                 "http://" + host + ":" + port],
+                profile.wrap(command) if profile else command,
                 stdout=subprocess.PIPE,
                 stderr=subprocess.STDOUT, universal_newlines=True)
 
@@ -455,27 +1873,42 @@ class LlamaServerWrapper(QMainWindow):
             line = self.api_process.stdout.readline()
             if not line:
                 break
-            self.on_output_received(line)
+            self.log.write(line)
 
     def on_server_started(self):
         print("Server started")
 
     def on_server_stopped(self):
         print("Server stopped")
+        # The standby models go with the active one
+        for process in list(self.model_processes.values()):
+            process.terminate()
+        self.active_model = None
+        self.switching = False
         if self.api_process:
             self.api_process.terminate()
             self.api_process.wait()
-        self.server_runner_thread.join()
-        self.server_runner_thread = None
+        if self.server_runner_thread is not None:
+            self.server_runner_thread.join()
+            self.server_runner_thread = None
 
         self.tab_widget.setTabVisible(1, 1)
         self.tab_widget.setTabVisible(2, 1)
+        self.tab_widget.setTabVisible(3, 0)
+        self.tab_widget.setTabVisible(4, 1)
         self.tab_widget.removeTab(0)
         self.tab_widget.insertTab(0, self.save_model_tab, 'Model Settings')
         self.tab_widget.setCurrentIndex(0)
         self.output_text.hide()
+        self.status_label.hide()
         self.stop_button.hide()
         self.model_chooser.show()
+        self.model_info_label.show()
+        self.gpu_budget_label.show()
+        self.gpu_budget_entry.show()
+        self.fit_button.show()
+        self.tune_button.show()
+        self.tune_status.show()
         self.gpu_layers_label.show()
         self.gpu_layers_entry.show()
         self.threads_label.show()
@@ -486,6 +1919,7 @@ class LlamaServerWrapper(QMainWindow):
         self.bth_size_entry.show()
         self.mlock_checkbox.show()
         self.lowvram_checkbox.show()
+        self.prewarm_checkbox.show()
         self.host_label.show()
         self.host_entry.show()
         self.port_label.show()
@@ -493,19 +1927,23 @@ class LlamaServerWrapper(QMainWindow):
         self.oai_checkbox.show()
         self.oaiport_label.show()
         self.oaiport_entry.show()
+        self.model_budget_label.show()
+        self.model_budget_entry.show()
+        self.log_file_checkbox.show()
+        self.placement_widget.show()
+        self.switch_chooser.hide()
+        self.switch_status.hide()
+        self.switch_button.hide()
+        self.switch_button.setEnabled(True)
         self.start_button.show()
 
-    def on_output_received(self, output):
-        # Remove leading and trailing whitespace
-        output = output.strip()
-
-        # Remove ANSI escape codes (used for formatting in some terminals)
-        output = re.sub(r'\x1B\[[0-?]*[ -/]*[@-~]', '', output)
-
-        # Append the cleaned output to the text area
-        self.output_text.appendPlainText(output)
-
     def stop_server(self):
+        if self.prewarm_cancel is not None:
+            self.prewarm_cancel.set()
+            return
+        for process in list(self.model_processes.values()):
+            if process.runner is not self.server_runner:
+                process.terminate()
         if self.server_runner:
             self.server_runner.process.terminate()
             self.server_runner.process.wait()
@@ -526,6 +1964,10 @@ class LlamaServerWrapper(QMainWindow):
                     model_path = config.get("Settings", "model_path")
                     self.model_chooser.model_entry.setText(model_path)
 
+                if config.has_option("Settings", "gpu_budget"):
+                    gpu_budget = config.get("Settings", "gpu_budget")
+                    self.gpu_budget_entry.setValue(int(gpu_budget))
+
                 if config.has_option("Settings", "gpu_layers"):
                     gpu_layers = config.get("Settings", "gpu_layers")
                     self.gpu_layers_entry.setValue(int(gpu_layers))
@@ -546,6 +1988,10 @@ class LlamaServerWrapper(QMainWindow):
                     mlock = config.get("Settings", "mlock")  # Load mlock setting
                     self.mlock_checkbox.setChecked(mlock == "True")  # Set checkbox state
 
+                if config.has_option("Settings", "prewarm"):
+                    prewarm = config.get("Settings", "prewarm")  # Load prewarm setting
+                    self.prewarm_checkbox.setChecked(prewarm == "True")  # Set checkbox state
+
                 if config.has_option("Settings", "lowvram"):
                     lowvram = config.get("Settings", "lowvram")  # Load lowvram setting
                     self.lowvram_checkbox.setChecked(lowvram == "True")  # Set checkbox state
@@ -574,6 +2020,35 @@ class LlamaServerWrapper(QMainWindow):
                     oaiport = config.get("Settings", "oaiport")  # Load port setting
                     self.oaiport_entry.setValue(int(oaiport))
 
+                if config.has_option("Settings", "log_file"):
+                    log_file = config.get("Settings", "log_file")  # Load log file setting
+                    self.log_file_checkbox.setChecked(log_file == "True")  # Set checkbox state
+
+                if config.has_option("Settings", "cpu_placement"):
+                    placement = config.get("Settings", "cpu_placement")  # Load launch profile
+                    for index in range(self.placement_chooser.count()):
+                        if str(self.placement_chooser.itemData(index)) == placement:
+                            self.placement_chooser.blockSignals(True)
+                            self.placement_chooser.setCurrentIndex(index)
+                            self.placement_chooser.blockSignals(False)
+                            self.cpu_list_entry.setEnabled(placement == 'custom')
+                            self.membind_checkbox.setEnabled(placement not in ('any', 'custom'))
+                if config.has_option("Settings", "cpu_list"):
+                    self.cpu_list_entry.setText(config.get("Settings", "cpu_list"))
+                if config.has_option("Settings", "membind"):
+                    self.membind_checkbox.setChecked(config.get("Settings", "membind") == "True")
+                if config.has_option("Settings", "nice"):
+                    self.nice_entry.setValue(int(config.get("Settings", "nice")))
+                if config.has_option("Settings", "io_priority"):
+                    self.io_priority_chooser.setCurrentIndex(
+                        max(0, self.io_priority_chooser.findData(int(config.get("Settings", "io_priority")))))
+                if config.has_option("Settings", "pin_wrapper"):
+                    self.pin_wrapper_checkbox.setChecked(config.get("Settings", "pin_wrapper") == "True")
+
+                if config.has_option("Settings", "model_budget"):
+                    model_budget = config.get("Settings", "model_budget")  # Load warm model budget
+                    self.model_budget_entry.setValue(int(model_budget))
+
     def save_settings(self, model_path, gpu_layers, threads, ctx_size, bth_size, mlock, lowvram, lora_path,
                       lorabase_path, host, port, oaiport):
         config = configparser.ConfigParser()
@@ -584,21 +2059,116 @@ class LlamaServerWrapper(QMainWindow):
         else:
             # Linux/Unix/Mac: Load settings from ~/.config
             config_file = os.path.join(os.path.expanduser("~"), ".config", "llama.cpp-qt", "settings.ini")
+        # Keep the other sections, like the recorded load times
+        if os.path.exists(config_file):
+            config.read(config_file)
         if not config.has_section("Settings"):
             config.add_section("Settings")
         config.set("Settings", "model_path", model_path)
         config.set("Settings", "gpu_layers", gpu_layers)
+        config.set("Settings", "gpu_budget", str(self.gpu_budget_entry.value()))  # Save GPU memory budget
         config.set("Settings", "threads", threads)
         config.set("Settings", "ctx_size", ctx_size)
         config.set("Settings", "bth_size", bth_size)
         config.set("Settings", "mlock", str(self.mlock_checkbox.isChecked()))  # Save mlock setting as string
         config.set("Settings", "lowvram", str(self.lowvram_checkbox.isChecked()))  # Save lowvram setting as string
+        config.set("Settings", "prewarm", str(self.prewarm_checkbox.isChecked()))  # Save prewarm setting as string
         config.set("Settings", "lora_path", lora_path)
         config.set("Settings", "lorabase_path", lorabase_path)
         config.set("Settings", "host", self.host_entry.text())  # Save host setting
         config.set("Settings", "port", str(self.port_entry.value()))  # Save port setting as string
         config.set("Settings", "oai", str(self.oai_checkbox.isChecked()))  # Save openai setting as string
         config.set("Settings", "oaiport", str(self.oaiport_entry.value()))  # Save port setting as string
+        config.set("Settings", "model_budget", str(self.model_budget_entry.value()))  # Save warm model budget
+        config.set("Settings", "log_file", str(self.log_file_checkbox.isChecked()))  # Save log file setting as string
+        config.set("Settings", "cpu_placement", str(self.placement_chooser.currentData()))  # Save launch profile
+        config.set("Settings", "cpu_list", self.cpu_list_entry.text())
+        config.set("Settings", "membind", str(self.membind_checkbox.isChecked()))
+        config.set("Settings", "nice", str(self.nice_entry.value()))
+        config.set("Settings", "io_priority", str(self.io_priority_chooser.currentData()))
+        config.set("Settings", "pin_wrapper", str(self.pin_wrapper_checkbox.isChecked()))
+        with open(config_file, "w") as configfile:
+            config.write(configfile)
+
+    # Load times are kept per model file name in the LoadTimes section of settings.ini
+    def load_time(self, model_path):
+        config = configparser.ConfigParser()
+        config.read(os.path.join(self.config_dir, "settings.ini"))
+        if config.has_option("LoadTimes", os.path.basename(model_path)):
+            return config.getfloat("LoadTimes", os.path.basename(model_path))
+        return None
+
+    def record_load_time(self, model_path, load_time):
+        config_file = os.path.join(self.config_dir, "settings.ini")
+        config = configparser.ConfigParser()
+        config.read(config_file)
+        if not config.has_section("LoadTimes"):
+            config.add_section("LoadTimes")
+        config.set("LoadTimes", os.path.basename(model_path), "%.1f" % load_time)
+        with open(config_file, "w") as configfile:
+            config.write(configfile)
+
+    # Suggest one thread per physical core of the CPUs chosen
+    def on_placement_changed(self, index):
+        placement = self.placement_chooser.itemData(index)
+        self.cpu_list_entry.setEnabled(placement == 'custom')
+        self.membind_checkbox.setEnabled(placement not in ('any', 'custom'))
+        if placement == 'any':
+            self.threads_entry.setValue(physical_cores([cpu for cpus, _ in self.cpu_topology.values() for cpu in cpus]))
+        elif placement != 'custom':
+            self.threads_entry.setValue(self.cpu_topology[placement][1])
+
+    def launch_profile(self):
+        placement = self.placement_chooser.currentData()
+        cpus = None
+        node = None
+        if placement == 'custom':
+            try:
+                cpus = parse_cpulist(self.cpu_list_entry.text()) or None
+            except ValueError:
+                self.log.write('Ignoring the CPU list ' + self.cpu_list_entry.text())
+        elif placement != 'any':
+            node = placement
+            cpus = self.cpu_topology[node][0]
+        return LaunchProfile(cpus, node, self.membind_checkbox.isChecked(), self.nice_entry.value(),
+                             self.io_priority_chooser.currentData(), self.log)
+
+    # Settings auto-tune found for a model on this host, keyed by model file name and host name
+    def tuned_settings(self, model_path):
+        config = configparser.ConfigParser(interpolation=None)
+        config.read(os.path.join(self.config_dir, "settings.ini"))
+        key = os.path.basename(model_path) + "@" + socket.gethostname()
+        if config.has_option("Tuning", key):
+            try:
+                return json.loads(config.get("Tuning", key))
+            except ValueError:
+                pass
+        return None
+
+    def record_tuned_settings(self, model_path, best):
+        config_file = os.path.join(self.config_dir, "settings.ini")
+        config = configparser.ConfigParser(interpolation=None)
+        config.read(config_file)
+        if not config.has_section("Tuning"):
+            config.add_section("Tuning")
+        config.set("Tuning", os.path.basename(model_path) + "@" + socket.gethostname(), json.dumps(best))
+        with open(config_file, "w") as configfile:
+            config.write(configfile)
+
+    def library_folders(self):
+        config = configparser.ConfigParser()
+        config.read(os.path.join(self.config_dir, "settings.ini"))
+        if config.has_option("Library", "folders"):
+            return [folder for folder in config.get("Library", "folders").split(os.pathsep) if folder]
+        return []
+
+    def save_library_folders(self):
+        config_file = os.path.join(self.config_dir, "settings.ini")
+        config = configparser.ConfigParser()
+        config.read(config_file)
+        if not config.has_section("Library"):
+            config.add_section("Library")
+        config.set("Library", "folders", os.pathsep.join(self.library_tab.folders()))
         with open(config_file, "w") as configfile:
             config.write(configfile)
 
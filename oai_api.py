@@ -1,14 +1,80 @@
 #!/usr/bin/env python3
 import argparse
-import urllib.parse
-import requests
+import array
+import asyncio
+import base64
+import bisect
+import functools
+import hashlib
+import math
+import multiprocessing
+import multiprocessing.connection
+import os
+import shutil
+import signal
+import socket
+import sys
+import tempfile
 import time
+from collections import OrderedDict, deque
 import json
+import httpx
+from contextlib import asynccontextmanager, nullcontext
 from fastapi import FastAPI, Response, HTTPException, Request
-from fastapi.responses import StreamingResponse
+from fastapi.responses import StreamingResponse, PlainTextResponse
+from starlette.background import BackgroundTask
 from fastapi.middleware.cors import CORSMiddleware
 
-app = FastAPI()
+try:
+    from fastchat import conversation
+except ImportError:
+    conversation = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# JSON of the request and streaming paths as bytes, with orjson when it is installed
+if (orjson is not None):
+    json_loads = orjson.loads
+    json_dumps = orjson.dumps
+else:
+    json_loads = json.loads
+
+    def json_dumps(value):
+        return json.dumps(value, ensure_ascii=False, separators=(",", ":")).encode()
+
+# Shared async client for server.cpp, created on startup so every request reuses pooled keep-alive connections
+client = None
+
+
+@asynccontextmanager
+async def lifespan(app):
+    global client
+    client = httpx.AsyncClient(
+        limits=httpx.Limits(max_connections=args.pool_size,
+                            max_keepalive_connections=args.pool_keepalive,
+                            keepalive_expiry=args.keepalive_expiry),
+        timeout=httpx.Timeout(connect=args.connect_timeout,
+                              read=args.read_timeout or None,
+                              write=args.connect_timeout,
+                              pool=None))
+    tasks = []
+    # With several workers the backend health is shared, so one worker probing is enough
+    if (args.health_interval > 0 and worker_id == 0):
+        tasks.append(asyncio.create_task(pool.health_loop()))
+    tasks.append(asyncio.create_task(pool.model_loop()))
+    if (shared):
+        tasks.append(asyncio.create_task(scheduler.dispatch_loop()))
+        tasks.append(asyncio.create_task(metrics_loop()))
+    yield
+    for task in tasks:
+        task.cancel()
+    await client.aclose()
+
+
+app = FastAPI(lifespan=lifespan)
 
 # Add CORS middleware to allow cross-origin requests (update origins as needed)
 app.add_middleware(
@@ -32,15 +98,94 @@ parser.add_argument("--ai-name", type=str, help="ASSISTANT name in chat completi
 parser.add_argument("--system-name", type=str, help="SYSTEM name in chat completions(default: '\\nASSISTANT's RULE: ')",
                     default="\\nASSISTANT's RULE: ")
 parser.add_argument("--stop", type=str, help="the end of response in chat completions(default: '</s>')", default="</s>")
+parser.add_argument("--chat-template", type=str,
+                    help="Named chat template: default (built from the options above), chatml, llama2, mistral, "
+                         "vicuna, alpaca or zephyr(default: default)",
+                    default="default")
+parser.add_argument("--model-template", type=str, action="append", default=[],
+                    help="Use a chat template for one model as MODEL=TEMPLATE, can be given several times")
 parser.add_argument("--llama-api", type=str,
-                    help="Set the address of server.cpp in llama.cpp(default: http://127.0.0.1:8080)",
+                    help="Set the address of server.cpp in llama.cpp, several comma separated addresses are load balanced(default: http://127.0.0.1:8080)",
                     default='http://127.0.0.1:8080')
+parser.add_argument("--balance", type=str, choices=["least-requests", "token-budget"],
+                    help="How requests are spread over several server.cpp(default: least-requests)",
+                    default="least-requests")
+parser.add_argument("--health-interval", type=float,
+                    help="Seconds between health checks of server.cpp, 0 to disable(default: 5)", default=5.0)
+parser.add_argument("--models-interval", type=float,
+                    help="Seconds between asking every server.cpp which model it serves, 0 to ask only at start(default: 30)",
+                    default=30.0)
+parser.add_argument("--eject-after", type=int,
+                    help="Consecutive failures before a server.cpp is taken out of rotation(default: 3)", default=3)
+parser.add_argument("--max-retries", type=int,
+                    help="How often a failed request is retried on another server.cpp, a stream only until its "
+                         "first data arrives(default: 2)",
+                    default=2)
+parser.add_argument("--pool-size", type=int,
+                    help="Set the maximum number of pooled connections to server.cpp(default: 100)", default=100)
+parser.add_argument("--pool-keepalive", type=int,
+                    help="Set the maximum number of idle keep-alive connections to server.cpp(default: 20)", default=20)
+parser.add_argument("--keepalive-expiry", type=float,
+                    help="Seconds an idle keep-alive connection is kept open(default: 30)", default=30.0)
+parser.add_argument("--connect-timeout", type=float,
+                    help="Seconds to wait for a connection to server.cpp(default: 5)", default=5.0)
+parser.add_argument("--read-timeout", type=float,
+                    help="Seconds to wait for data from server.cpp, 0 to disable(default: 600)", default=600.0)
+parser.add_argument("--no-cache-prompt", dest="cache_prompt", action="store_false",
+                    help="Do not ask server.cpp to reuse the KV cache of a common prompt prefix")
+parser.add_argument("--prefix-block", type=int,
+                    help="Characters per block of the prompt prefix index(default: 64)", default=64)
+parser.add_argument("--affinity-slack", type=int,
+                    help="Extra outstanding requests accepted to reach the backend caching a prompt prefix(default: 2)",
+                    default=2)
+parser.add_argument("--max-concurrency", type=int,
+                    help="Requests forwarded at once to each server.cpp, 0 for no limit(default: 4)", default=4)
+parser.add_argument("--max-queue", type=int,
+                    help="Requests allowed to wait for a free server.cpp before answering 429(default: 100)",
+                    default=100)
+parser.add_argument("--max-queue-wait", type=float,
+                    help="Seconds a request may wait in the queue before answering 429(default: 30)", default=30.0)
+parser.add_argument("--long-max-tokens", type=int,
+                    help="Requests with a larger max_tokens are scheduled in the long lane(default: 512)", default=512)
+parser.add_argument("--long-lane-share", type=float,
+                    help="Share of the request slots the long lane may occupy(default: 0.5)", default=0.5)
+parser.add_argument("--cache", action="store_true",
+                    help="Cache answers of deterministic requests (temperature 0 or a fixed seed)")
+parser.add_argument("--cache-size", type=int, help="Answers kept in the memory cache(default: 1024)", default=1024)
+parser.add_argument("--cache-dir", type=str, help="Directory of the on-disk cache, empty to disable(default: '')",
+                    default="")
+parser.add_argument("--cache-disk-size", type=int, help="Size limit of the on-disk cache in MB(default: 1024)",
+                    default=1024)
+parser.add_argument("--cache-ttl", type=float, help="Seconds a cached answer stays valid(default: 86400)",
+                    default=86400.0)
+parser.add_argument("--tokenize-cache-size", type=int,
+                    help="Tokenized prompts kept to answer the tokenize option without asking server.cpp(default: 256)",
+                    default=256)
+parser.add_argument("--embedding-concurrency", type=int,
+                    help="Inputs of one embeddings request sent to server.cpp at once(default: 8)", default=8)
+parser.add_argument("--admin-key", type=str,
+                    help="Enable /admin/backends to replace the server.cpp list at runtime, with this key(default: disabled)",
+                    default="")
 parser.add_argument("--api-key", type=str, help="Set the api key to allow only few user(default: NULL)", default="")
 parser.add_argument("--host", type=str, help="Set the ip address to listen.(default: 127.0.0.1)", default='127.0.0.1')
 parser.add_argument("--port", type=int, help="Set the port to listen.(default: 8081)", default=8081)
+parser.add_argument("--workers", type=int,
+                    help="Worker processes sharing the port, backend state, queue, caches and metrics(default: 1)",
+                    default=1)
+parser.add_argument("--prefix-table-size", type=int,
+                    help="Entries of the prefix affinity table shared by several workers(default: 65536)",
+                    default=65536)
 
 args = parser.parse_args()
 
+# With several workers the supervisor creates the shared state below before forking, so every worker
+# inherits the same shared memory and state directory
+shared = args.workers > 1
+if (shared and not hasattr(os, "fork")):
+    parser.error("--workers needs a platform with fork")
+state_dir = tempfile.mkdtemp(prefix="oai_api-") if (shared) else ""
+worker_id = 0
+
 
 def is_present(json, key):
     try:
@@ -50,19 +195,61 @@ def is_present(json, key):
     return True
 
 
-use_conversation_template = args.chat_prompt_model != "" and conversation is not None
+def unescape(text):
+    return text.replace("\\n", "\n")
 
-if use_conversation_template:
-    conv = conversation.get_conv_template(args.chat_prompt_model)
-    stop_token = conv.stop_str
-else:
-    stop_token = args.stop
 
+# A chat prompt format. Every role has a prefix and a suffix around the message, and `generation` opens
+# the answer of the assistant. With `system_in_user` the system messages are put in front of the next user
+# message, inside its prefix, as Llama 2 and Mistral expect. All strings are unescaped once here rather
+# than on every request.
+class ChatTemplate:
+    def __init__(self, top="", system=("", ""), user=("", ""), assistant=("", ""), generation="", stop="",
+                 system_in_user=False):
+        self.top = unescape(top)
+        self.roles = {
+            "system": tuple(unescape(part) for part in system),
+            "user": tuple(unescape(part) for part in user),
+            "assistant": tuple(unescape(part) for part in assistant),
+        }
+        self.generation = unescape(generation)
+        self.stop = unescape(stop)
+        self.system_in_user = system_in_user
 
-# convert chat to prompt
-def convert_chat(messages):
-    if use_conversation_template:
-        conv = conversation.get_conv_template(args.chat_prompt_model)
+    def render_messages(self, messages):
+        parts = []
+        system = []
+        for line in messages:
+            role = self.roles.get(line["role"])
+            if (role is None):
+                continue
+            if (self.system_in_user and line["role"] == "system"):
+                system += [role[0], line["content"] or "", role[1]]
+                continue
+            parts.append(role[0])
+            if (line["role"] == "user"):
+                parts += system
+                system = []
+            parts.append(line["content"] or "")
+            parts.append(role[1])
+        # System messages no user message followed are sent as one
+        if (system):
+            parts += [self.roles["user"][0]] + system + [self.roles["user"][1]]
+        return "".join(parts)
+
+    def render(self, messages):
+        return self.top + self.render_messages(messages) + self.generation
+
+
+# Conversation templates of FastChat, when it is installed. These are built per request by FastChat
+# itself, so nothing is precompiled or memoized for them.
+class FastChatTemplate:
+    def __init__(self, name):
+        self.name = name
+        self.stop = conversation.get_conv_template(name).stop_str or ""
+
+    def render(self, messages):
+        conv = conversation.get_conv_template(self.name)
         for line in messages:
             if (line["role"] == "system"):
                 try:
@@ -74,36 +261,89 @@ def convert_chat(messages):
             elif (line["role"] == "assistant"):
                 conv.append_message(conv.roles[1], line["content"])
         conv.append_message(conv.roles[1], None)
-        prompt = conv.get_prompt()
-    else:
-        prompt = "" + args.chat_prompt.replace("\\n", "\n")
-        system_n = args.system_name.replace("\\n", "\n")
-        user_n = args.user_name.replace("\\n", "\n")
-        ai_n = args.ai_name.replace("\\n", "\n")
-        stop = stop_token.replace("\\n", "\n")
+        return conv.get_prompt()
 
-        for line in messages:
-            if (line["role"] == "system"):
-                prompt += f"{system_n}{line['content']}"
-            if (line["role"] == "user"):
-                prompt += f"{user_n}{line['content']}"
-            if (line["role"] == "assistant"):
-                prompt += f"{ai_n}{line['content']}{stop}"
-        prompt += ai_n.rstrip()
 
-    return prompt
+chat_templates = {
+    "default": ChatTemplate(top=args.chat_prompt,
+                            system=(args.system_name, ""),
+                            user=(args.user_name, ""),
+                            assistant=(args.ai_name, args.stop),
+                            generation=unescape(args.ai_name).rstrip(),
+                            stop=args.stop),
+    "chatml": ChatTemplate(system=("<|im_start|>system\\n", "<|im_end|>\\n"),
+                           user=("<|im_start|>user\\n", "<|im_end|>\\n"),
+                           assistant=("<|im_start|>assistant\\n", "<|im_end|>\\n"),
+                           generation="<|im_start|>assistant\\n",
+                           stop="<|im_end|>"),
+    "llama2": ChatTemplate(system=("<<SYS>>\\n", "\\n<</SYS>>\\n\\n"),
+                           user=("[INST] ", " [/INST]"),
+                           assistant=(" ", " </s><s>"),
+                           stop="</s>",
+                           system_in_user=True),
+    "mistral": ChatTemplate(system=("", "\\n\\n"),
+                            user=("[INST] ", " [/INST]"),
+                            assistant=("", "</s> "),
+                            stop="</s>",
+                            system_in_user=True),
+    "vicuna": ChatTemplate(top="A chat between a curious user and an artificial intelligence assistant. "
+                               "The assistant gives helpful, detailed, and polite answers to the user's questions.",
+                           system=("\\n", ""),
+                           user=(" USER: ", ""),
+                           assistant=(" ASSISTANT: ", "</s>"),
+                           generation=" ASSISTANT:",
+                           stop="</s>"),
+    "alpaca": ChatTemplate(system=("", "\\n\\n"),
+                           user=("### Instruction:\\n", "\\n\\n"),
+                           assistant=("### Response:\\n", "\\n\\n"),
+                           generation="### Response:\\n",
+                           stop="### Instruction:"),
+    "zephyr": ChatTemplate(system=("<|system|>\\n", "</s>\\n"),
+                           user=("<|user|>\\n", "</s>\\n"),
+                           assistant=("<|assistant|>\\n", "</s>\\n"),
+                           generation="<|assistant|>\\n",
+                           stop="</s>"),
+}
+
+if (args.chat_prompt_model != "" and conversation is None):
+    print("FastChat is not installed, --chat-prompt-model is ignored")
+if (args.chat_prompt_model != "" and conversation is not None):
+    chat_templates[args.chat_prompt_model] = FastChatTemplate(args.chat_prompt_model)
+    default_template = args.chat_prompt_model
+else:
+    default_template = args.chat_template
+if (default_template not in chat_templates):
+    parser.error("unknown chat template: {}".format(default_template))
+
+model_templates = {}
+for mapping in args.model_template:
+    model, _, name = mapping.partition("=")
+    if (name not in chat_templates):
+        parser.error("unknown chat template: {}".format(name))
+    model_templates[model] = name
+
+
+def template_for(model=None):
+    return chat_templates[model_templates.get(model, default_template)]
+
+
+# convert chat to prompt
+def convert_chat(messages, model=None):
+    return template_for(model).render(messages)
 
 
 def make_postData(body, chat=False, stream=False):
     postData = {}
+    template = template_for(body.get("model"))
     if (chat):
-        postData["prompt"] = convert_chat(body["messages"])
+        postData["prompt"] = convert_chat(body["messages"], body.get("model"))
     else:
         postData["prompt"] = body["prompt"]
     if (is_present(body, "temperature")): postData["temperature"] = body["temperature"]
     if (is_present(body, "top_k")): postData["top_k"] = body["top_k"]
     if (is_present(body, "top_p")): postData["top_p"] = body["top_p"]
-    if (is_present(body, "max_tokens")): postData["n_predict"] = body["max_tokens"]
+    # "max_tokens": null asks for no limit, which server.cpp spells -1
+    if (is_present(body, "max_tokens")): postData["n_predict"] = -1 if (body["max_tokens"] is None) else body["max_tokens"]
     if (is_present(body, "presence_penalty")): postData["presence_penalty"] = body["presence_penalty"]
     if (is_present(body, "frequency_penalty")): postData["frequency_penalty"] = body["frequency_penalty"]
     if (is_present(body, "repeat_penalty")): postData["repeat_penalty"] = body["repeat_penalty"]
@@ -113,24 +353,39 @@ def make_postData(body, chat=False, stream=False):
     if (is_present(body, "seed")): postData["seed"] = body["seed"]
     if (is_present(body, "logit_bias")): postData["logit_bias"] = [[int(token), body["logit_bias"][token]] for token in
                                                                    body["logit_bias"].keys()]
-    if stop_token:  # "" or None
-        postData["stop"] = [stop_token]
+    if template.stop:  # "" or None
+        postData["stop"] = [template.stop]
     else:
         postData["stop"] = []
-    if (is_present(body, "stop")): postData["stop"] += body["stop"] or []
+    if (is_present(body, "stop")):
+        postData["stop"] += [body["stop"]] if (isinstance(body["stop"], str)) else body["stop"] or []
+    # Routes the request to the backends serving this model, and keeps answers of different models apart
+    if (is_present(body, "model")): postData["model"] = body["model"]
     postData["n_keep"] = -1
+    # Let server.cpp reuse the KV cache of the common prefix instead of evaluating the whole prompt again
+    postData["cache_prompt"] = args.cache_prompt
     postData["stream"] = stream
 
     return postData
 
 
-def make_resData(data, chat=False, promptToken=[]):
+# Reported when the model of a backend is not known
+DEFAULT_MODEL = "LLaMA_CPP"
+
+
+# The model id of a model file, its name without the .gguf extension
+def model_name(path):
+    name = os.path.basename(str(path or "").rstrip("/\\"))
+    return name[:-5] if (name.endswith(".gguf")) else name
+
+
+def make_resData(data, chat=False, promptToken=[], index=0):
     resData = {
         "id": "chatcmpl" if (chat) else "cmpl",
         "object": "chat.completion" if (chat) else "text_completion",
         "created": int(time.time()),
         "truncated": data["truncated"],
-        "model": "LLaMA_CPP",
+        "model": data.get("model") or DEFAULT_MODEL,
         "usage": {
             "prompt_tokens": data["tokens_evaluated"],
             "completion_tokens": data["tokens_predicted"],
@@ -140,9 +395,8 @@ def make_resData(data, chat=False, promptToken=[]):
     if (len(promptToken) != 0):
         resData["promptToken"] = promptToken
     if (chat):
-        # only one choice is supported
         resData["choices"] = [{
-            "index": 0,
+            "index": index,
             "message": {
                 "role": "assistant",
                 "content": data["content"],
@@ -150,26 +404,41 @@ def make_resData(data, chat=False, promptToken=[]):
             "finish_reason": "stop" if (data["stopped_eos"] or data["stopped_word"]) else "length"
         }]
     else:
-        # only one choice is supported
         resData["choices"] = [{
             "text": data["content"],
-            "index": 0,
+            "index": index,
             "logprobs": None,
             "finish_reason": "stop" if (data["stopped_eos"] or data["stopped_word"]) else "length"
         }]
     return resData
 
 
-def make_resData_stream(data, chat=False, time_now=0, start=False):
+# Merge the answers of a fanned out request into one response. Choice i answers prompt i // n, and the
+# prompt tokens of each prompt are only counted once.
+def merge_resData(datas, chat=False, promptToken=[], n=1):
+    resData = make_resData(datas[0], chat=chat, promptToken=promptToken)
+    resData["choices"] = [make_resData(data, chat=chat, index=i)["choices"][0] for i, data in enumerate(datas)]
+    resData["truncated"] = any(data["truncated"] for data in datas)
+    prompt_tokens = sum(data["tokens_evaluated"] for data in datas[::n])
+    completion_tokens = sum(data["tokens_predicted"] for data in datas)
+    resData["usage"] = {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens
+    }
+    return resData
+
+
+def make_resData_stream(data, chat=False, time_now=0, start=False, index=0, model=DEFAULT_MODEL):
     resData = {
         "id": "chatcmpl" if (chat) else "cmpl",
         "object": "chat.completion.chunk" if (chat) else "text_completion.chunk",
         "created": time_now,
-        "model": "LLaMA_CPP",
+        "model": model,
         "choices": [
             {
                 "finish_reason": None,
-                "index": 0
+                "index": index
             }
         ]
     }
@@ -194,107 +463,1730 @@ def make_resData_stream(data, chat=False, time_now=0, start=False):
     return resData
 
 
-@app.post('/chat/completions')
-@app.post('/v1/chat/completions')
-async def chat_completions(request: Request):
-    if (args.api_key != "" and request.headers["Authorization"].split()[1] != args.api_key):
-        return Response(status_code=403)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+RATE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+# Counters and histograms rendered in the Prometheus text format by /metrics. Labels are passed as a
+# tuple of (name, value) pairs.
+class Metrics:
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+        self.buckets = {
+            "oai_queue_wait_seconds": LATENCY_BUCKETS,
+            "oai_time_to_first_token_seconds": LATENCY_BUCKETS,
+            "oai_inter_token_seconds": LATENCY_BUCKETS,
+            "oai_request_duration_seconds": LATENCY_BUCKETS,
+            "oai_upstream_connect_seconds": LATENCY_BUCKETS,
+            "oai_prompt_tokens_per_second": RATE_BUCKETS,
+            "oai_generation_tokens_per_second": RATE_BUCKETS,
+        }
+
+    def inc(self, name, labels=(), value=1):
+        key = (name, labels)
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, labels, value):
+        histogram = self.histograms.get((name, labels))
+        if (histogram is None):
+            histogram = self.histograms[(name, labels)] = Histogram(self.buckets[name])
+        histogram.observe(value)
+
+    def snapshot(self):
+        return {"counters": [[name, labels, value] for (name, labels), value in self.counters.items()],
+                "histograms": [[name, labels, histogram.counts, histogram.sum, histogram.count]
+                               for (name, labels), histogram in self.histograms.items()]}
+
+    def merge(self, snapshot):
+        for name, labels, value in snapshot["counters"]:
+            self.inc(name, tuple(tuple(label) for label in labels), value)
+        for name, labels, counts, total, count in snapshot["histograms"]:
+            key = (name, tuple(tuple(label) for label in labels))
+            histogram = self.histograms.get(key)
+            if (histogram is None):
+                histogram = self.histograms[key] = Histogram(self.buckets[name])
+            histogram.counts = [a + b for a, b in zip(histogram.counts, counts)]
+            histogram.sum += total
+            histogram.count += count
+
+    def render(self, gauges=()):
+        lines = []
+        typed = set()
+
+        def declare(name, kind):
+            if (name not in typed):
+                typed.add(name)
+                lines.append("# TYPE {} {}".format(name, kind))
+
+        for (name, labels), value in sorted(self.counters.items(), key=lambda item: item[0][0]):
+            declare(name, "counter")
+            lines.append(self.format(name, labels, value))
+        for (name, labels), value in gauges:
+            declare(name, "gauge")
+            lines.append(self.format(name, labels, value))
+        for (name, labels), histogram in sorted(self.histograms.items(), key=lambda item: item[0][0]):
+            declare(name, "histogram")
+            cumulative = 0
+            for bound, count in zip(histogram.buckets + ("+Inf",), histogram.counts):
+                cumulative += count
+                lines.append(self.format(name + "_bucket", labels + (("le", bound),), cumulative))
+            lines.append(self.format(name + "_sum", labels, histogram.sum))
+            lines.append(self.format(name + "_count", labels, histogram.count))
+        return "\n".join(lines) + "\n"
+
+    def format(self, name, labels, value):
+        text = ",".join('{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"')) for k, v in labels)
+        return "{}{{{}}} {}".format(name, text, value) if (text) else "{} {}".format(name, value)
+
+
+metrics = Metrics()
+
+
+# Timing of one proxied request. Records queue wait, connect time, time to first token and the gaps
+# between tokens as they happen, and logs one JSON line per request when it is finished.
+class RequestTimer:
+    def __init__(self, route):
+        self.route = route
+        self.start = time.monotonic()
+        self.backend = ""
+        self.queue_wait = 0.0
+        self.connect = None
+        self.first_token = None
+        self.last_token = None
+        self.data = None
+        self.cached = False
+        self.finished = False
+
+    # httpx calls this for every step of the request, only new connections report connect_tcp
+    async def trace(self, event, info):
+        if (event == "connection.connect_tcp.started"):
+            self.connect = time.monotonic()
+        elif (event == "connection.connect_tcp.complete" and self.connect is not None):
+            self.connect = time.monotonic() - self.connect
+            metrics.observe("oai_upstream_connect_seconds", (("backend", self.backend),), self.connect)
+
+    def queued(self, ticket):
+        self.queue_wait = ticket.wait
+        metrics.observe("oai_queue_wait_seconds", (("route", self.route),), ticket.wait)
+
+    def token(self):
+        now = time.monotonic()
+        if (self.first_token is None):
+            self.first_token = now
+            metrics.observe("oai_time_to_first_token_seconds", (("route", self.route),), now - self.start)
+        else:
+            metrics.observe("oai_inter_token_seconds", (("route", self.route),), now - self.last_token)
+        self.last_token = now
+
+    def finish(self):
+        if (self.finished):
+            return
+        self.finished = True
+        duration = time.monotonic() - self.start
+        labels = (("route", self.route),)
+        metrics.observe("oai_request_duration_seconds", labels, duration)
+        record = {"route": self.route, "backend": self.backend, "cached": self.cached,
+                  "queue_wait": round(self.queue_wait, 4), "duration": round(duration, 4)}
+        if (self.connect is not None and self.connect < duration):
+            record["connect"] = round(self.connect, 4)
+        if (self.first_token is not None):
+            record["ttft"] = round(self.first_token - self.start, 4)
+        data = self.data
+        if (data is not None and not self.cached):
+            # A stream cut short at a stop string never learns how many prompt tokens there were
+            if ("tokens_evaluated" in data):
+                metrics.inc("oai_prompt_tokens_total", labels, data["tokens_evaluated"])
+                record["prompt_tokens"] = data["tokens_evaluated"]
+            metrics.inc("oai_completion_tokens_total", labels, data.get("tokens_predicted", 0))
+            record["completion_tokens"] = data.get("tokens_predicted", 0)
+            timings = data.get("timings") or {}
+            if (timings.get("prompt_per_second")):
+                metrics.observe("oai_prompt_tokens_per_second", labels, timings["prompt_per_second"])
+                record["prompt_per_second"] = round(timings["prompt_per_second"], 2)
+            if (timings.get("predicted_per_second")):
+                metrics.observe("oai_generation_tokens_per_second", labels, timings["predicted_per_second"])
+                record["predicted_per_second"] = round(timings["predicted_per_second"], 2)
+        print(json.dumps(record), flush=True)
+
+
+# Integer counters seen by every worker. With several workers they live in shared memory, otherwise in a
+# plain list. The counters named in `per_worker` have a slice per worker, written only by that worker and
+# read as the sum of all slices, so the supervisor can zero the slice of a worker that died. `lock` guards
+# the read-modify-write updates of the other counters.
+class SharedCounters:
+    def __init__(self, names, per_worker=()):
+        self.per_worker = set(per_worker)
+        self.index = {}
+        size = 0
+        for name in names:
+            self.index[name] = size
+            size += args.workers if (name in self.per_worker) else 1
+        if (shared):
+            self.values = multiprocessing.RawArray("q", size)
+            self.lock = multiprocessing.Lock()
+        else:
+            self.values = [0] * size
+            self.lock = nullcontext()
+
+    # Position of the value this worker writes
+    def position(self, name):
+        return self.index[name] + (worker_id if (name in self.per_worker) else 0)
+
+    def slices(self, name):
+        i = self.index[name]
+        return self.values[i:i + args.workers] if (name in self.per_worker) else [self.values[i]]
+
+    def __getitem__(self, name):
+        return sum(self.slices(name))
+
+    def __setitem__(self, name, value):
+        self.values[self.position(name)] = value
+
+    def add(self, name, value):
+        self.update(name, lambda current: current + value)
+
+    def update(self, name, function):
+        i = self.position(name)
+        if (name in self.per_worker):
+            self.values[i] = function(self.values[i])
+            return
+        with self.lock:
+            self.values[i] = function(self.values[i])
+
+    def clear_worker(self, worker):
+        for name in self.per_worker:
+            self.values[self.index[name] + worker] = 0
+
+    def items(self):
+        return [(name, self[name]) for name in self.index]
+
+
+# Slots at or past this id are not tracked as busy
+MAX_SLOTS = 63
+
+
+class Backend:
+    def __init__(self, url):
+        self.url = url.rstrip("/")
+        self.state = SharedCounters(("healthy", "failures", "outstanding", "outstanding_tokens", "busy_slots"),
+                                    per_worker=("outstanding", "outstanding_tokens", "busy_slots"))
+        self.state["healthy"] = 1
+        # Model id reported by the backend and when it was first seen, None until known
+        self.model = None
+        self.model_created = 0
+
+    @property
+    def healthy(self):
+        return bool(self.state["healthy"])
+
+    @property
+    def failures(self):
+        return self.state["failures"]
+
+    @property
+    def outstanding(self):
+        return self.state["outstanding"]
+
+    @property
+    def outstanding_tokens(self):
+        return self.state["outstanding_tokens"]
+
+    def slot_busy(self, slot):
+        return 0 <= slot < MAX_SLOTS and any(mask >> slot & 1 for mask in self.state.slices("busy_slots"))
+
+    def set_slot_busy(self, slot, busy):
+        if (slot is not None and 0 <= slot < MAX_SLOTS):
+            bit = 1 << slot
+            self.state.update("busy_slots", lambda mask: mask | bit if (busy) else mask & ~bit)
+
+
+class PrefixNode:
+    __slots__ = ("parent", "key", "children", "owners")
+
+    def __init__(self, parent=None, key=None):
+        self.parent = parent
+        self.key = key
+        self.children = {}
+        self.owners = set()
+
+
+# Trie over fixed size blocks of prompt text, remembering which backend slot last held each prefix in
+# its KV cache. A slot only caches its latest prompt, so inserting for a slot drops its previous path.
+class PrefixIndex:
+    def __init__(self, block=64):
+        self.block = block
+        self.root = PrefixNode()
+        self.paths = {}
+
+    def keys(self, prompt):
+        return [hashlib.blake2b(prompt[i:i + self.block].encode(), digest_size=8).digest()
+                for i in range(0, len(prompt) - self.block + 1, self.block)]
+
+    # Map every backend url holding part of the prompt to (matched blocks, slot id)
+    def lookup(self, prompt):
+        matches = {}
+        node = self.root
+        for depth, key in enumerate(self.keys(prompt), 1):
+            node = node.children.get(key)
+            if (node is None):
+                break
+            for url, slot in node.owners:
+                matches[url] = (depth, slot)
+        return matches
+
+    def insert(self, prompt, url, slot):
+        self.remove(url, slot)
+        nodes = []
+        node = self.root
+        for key in self.keys(prompt):
+            child = node.children.get(key)
+            if (child is None):
+                child = node.children[key] = PrefixNode(node, key)
+            node = child
+            node.owners.add((url, slot))
+            nodes.append(node)
+        self.paths[(url, slot)] = nodes
+
+    def remove(self, url, slot):
+        for node in reversed(self.paths.pop((url, slot), [])):
+            node.owners.discard((url, slot))
+            if (not node.owners and not node.children):
+                del node.parent.children[node.key]
+
+
+# Prefix affinity for several workers, as a hash table in shared memory instead of the trie. A row maps
+# (prompt prefix, backend) to the slot that holds it as (tag, backend, slot + 1, generation). A slot only
+# caches its latest prompt, so inserting for a slot bumps its generation and its older rows stop matching.
+# Colliding rows overwrite each other, which only costs a cache hit.
+class SharedPrefixIndex:
+    WAYS = 4
+
+    def __init__(self, urls, block=64, size=65536):
+        self.urls = [url.rstrip("/") for url in urls]
+        self.block = block
+        self.size = size
+        self.rows = multiprocessing.RawArray("q", size * 4)
+        self.generations = multiprocessing.RawArray("q", len(urls) * (MAX_SLOTS + 1))
+        self.lock = multiprocessing.Lock()
+
+    # One hash per block, each covering the whole prompt up to the end of that block
+    def keys(self, prompt):
+        digest = hashlib.blake2b(digest_size=8)
+        keys = []
+        for i in range(0, len(prompt) - self.block + 1, self.block):
+            digest.update(prompt[i:i + self.block].encode())
+            keys.append(int.from_bytes(digest.digest(), "little"))
+        return keys
+
+    def tag(self, key, backend):
+        return ((key + backend * 0x9E3779B97F4A7C15) & 0x7FFFFFFFFFFFFFFF) | 1
+
+    def find(self, tag, backend):
+        for way in range(self.WAYS):
+            row = (tag + way) % self.size * 4
+            if (self.rows[row] == tag and self.rows[row + 1] == backend):
+                code = self.rows[row + 2]
+                if (self.generations[backend * (MAX_SLOTS + 1) + code] == self.rows[row + 3]):
+                    return code
+        return -1
+
+    def lookup(self, prompt):
+        matches = {}
+        keys = self.keys(prompt)
+        with self.lock:
+            for depth, key in enumerate(keys, 1):
+                found = False
+                for backend, url in enumerate(self.urls):
+                    code = self.find(self.tag(key, backend), backend)
+                    if (code >= 0):
+                        matches[url] = (depth, code - 1 if (code) else None)
+                        found = True
+                if (not found):
+                    break
+        return matches
+
+    def insert(self, prompt, url, slot):
+        if (url not in self.urls or (slot is not None and not 0 <= slot < MAX_SLOTS)):
+            return
+        backend = self.urls.index(url)
+        code = 0 if (slot is None) else slot + 1
+        keys = self.keys(prompt)
+        with self.lock:
+            generation = self.generations[backend * (MAX_SLOTS + 1) + code] + 1
+            self.generations[backend * (MAX_SLOTS + 1) + code] = generation
+            for key in keys:
+                tag = self.tag(key, backend)
+                # Reuse the row of this prefix, else a stale row, else evict the first way
+                target = None
+                for way in range(self.WAYS):
+                    row = (tag + way) % self.size * 4
+                    if (self.rows[row] == tag and self.rows[row + 1] == backend):
+                        target = row
+                        break
+                    stale = self.generations[self.rows[row + 1] * (MAX_SLOTS + 1) + self.rows[row + 2]] != \
+                        self.rows[row + 3]
+                    if (target is None and (self.rows[row] == 0 or stale)):
+                        target = row
+                if (target is None):
+                    target = tag % self.size * 4
+                self.rows[target:target + 4] = [tag, backend, code, generation]
+
+
+class BackendPool:
+    def __init__(self, urls, balance="least-requests", eject_after=3, prefix_index=None, affinity_slack=2,
+                 max_concurrency=0):
+        self.backends = [Backend(url) for url in urls]
+        # Backends replaced while still answering requests, listed until those are done
+        self.draining = []
+        self.balance = balance
+        self.eject_after = eject_after
+        self.max_concurrency = max_concurrency
+        self.prefix_index = prefix_index
+        self.affinity_slack = affinity_slack
+
+    # Return (backend, slot id). With a prompt, a backend that already caches a prefix of it wins as
+    # long as it is not much busier than the least loaded one.
+    def pick(self, exclude=(), prompt=None, model=None):
+        # Only the backends serving the requested model, unless no backend serves a model of that name
+        backends = [b for b in self.backends if b.model == model] if (model is not None) else []
+        candidates = [b for b in (backends or self.backends) if b not in exclude]
+        # When every backend looks dead, still try them rather than failing outright
+        healthy = [b for b in candidates if b.healthy]
+        candidates = healthy or candidates
+        if (self.max_concurrency):
+            candidates = [b for b in candidates if b.outstanding < self.max_concurrency] or candidates
+        if (not candidates):
+            return None, None
+        if (self.balance == "token-budget"):
+            best = min(candidates, key=lambda b: (b.outstanding_tokens, b.outstanding))
+        else:
+            best = min(candidates, key=lambda b: (b.outstanding, b.outstanding_tokens))
+        if (prompt is None or self.prefix_index is None):
+            return best, None
+
+        matches = self.prefix_index.lookup(prompt)
+        affine = [b for b in candidates
+                  if b.url in matches and b.outstanding <= best.outstanding + self.affinity_slack]
+        if (not affine):
+            return best, None
+        backend = max(affine, key=lambda b: matches[b.url][0])
+        slot = matches[backend.url][1]
+        # Pinning a slot that is still generating for someone else would make server.cpp reject the request
+        if (slot is None or backend.slot_busy(slot)):
+            slot = None
+        return backend, slot
+
+    @asynccontextmanager
+    async def use(self, backend, cost=0, slot=None):
+        backend.state.add("outstanding", 1)
+        backend.state.add("outstanding_tokens", cost)
+        backend.set_slot_busy(slot, True)
+        try:
+            yield backend
+        finally:
+            backend.state.add("outstanding", -1)
+            backend.state.add("outstanding_tokens", -cost)
+            backend.set_slot_busy(slot, False)
+
+    def mark_success(self, backend):
+        backend.state["failures"] = 0
+        backend.state["healthy"] = 1
+
+    def mark_failure(self, backend):
+        backend.state.add("failures", 1)
+        if (backend.failures >= self.eject_after):
+            backend.state["healthy"] = 0
+
+    # Remember which slot now holds the prompt and its answer in the KV cache
+    def remember(self, backend, prompt, data):
+        if (self.prefix_index is None or not isinstance(prompt, str)):
+            return
+        slot = data.get("slot_id", data.get("id_slot"))
+        self.prefix_index.insert(prompt + data.get("content", ""), backend.url, slot)
+
+    async def check(self, backend):
+        try:
+            res = await client.get(backend.url + "/health", timeout=args.connect_timeout)
+        except httpx.HTTPError:
+            self.mark_failure(backend)
+            return
+        # Older server.cpp builds have no /health and answer 404, which still means they are up
+        if (res.status_code < 500):
+            self.mark_success(backend)
+        else:
+            self.mark_failure(backend)
+
+    # Ask a backend which model it serves. server.cpp reports the model file in /props, newer builds
+    # also list it in an OpenAI style /v1/models.
+    async def discover(self, backend):
+        model = None
+        try:
+            res = await client.get(backend.url + "/props", timeout=args.connect_timeout)
+            if (res.status_code == 200):
+                props = res.json()
+                model = (props.get("default_generation_settings") or {}).get("model") or props.get("model_path")
+            if (not model):
+                res = await client.get(backend.url + "/v1/models", timeout=args.connect_timeout)
+                if (res.status_code == 200):
+                    model = (res.json().get("data") or [{}])[0].get("id")
+        except (httpx.HTTPError, ValueError, AttributeError, TypeError):
+            return
+        model = model_name(model) or None
+        if (model is not None and model != backend.model):
+            backend.model = model
+            backend.model_created = int(time.time())
+
+    # Swap in a new list of backends at once. Backends that stay keep their state, requests running on a
+    # removed backend finish there, and the models of new backends are known before they get traffic.
+    async def replace(self, urls):
+        current = {b.url: b for b in self.draining + self.backends}
+        backends = [current.get(url.rstrip("/")) or Backend(url) for url in urls]
+        await asyncio.gather(*[self.discover(b) for b in backends if (b.model is None)])
+        self.draining = [b for b in current.values() if (b not in backends)]
+        self.backends = backends
+
+    def draining_backends(self):
+        self.draining = [b for b in self.draining if (b.outstanding)]
+        return self.draining
+
+    # The model id reported in answers of a backend
+    def model_of(self, backend, data=None):
+        return backend.model or model_name((data or {}).get("model")) or DEFAULT_MODEL
+
+    # Models served by the backends in the order of --llama-api, with when they were first seen
+    def models(self):
+        models = {}
+        for backend in self.backends:
+            if (backend.model is not None and backend.model not in models):
+                models[backend.model] = backend.model_created
+        return models
+
+    async def model_loop(self):
+        while True:
+            await asyncio.gather(*[self.discover(b) for b in self.backends])
+            if (args.models_interval <= 0):
+                return
+            await asyncio.sleep(args.models_interval)
+
+    async def health_loop(self):
+        while True:
+            await asyncio.gather(*[self.check(b) for b in self.backends])
+            await asyncio.sleep(args.health_interval)
+
+
+if (not args.cache_prompt):
+    prefix_index = None
+elif (shared):
+    prefix_index = SharedPrefixIndex(args.llama_api.split(","), args.prefix_block, args.prefix_table_size)
+else:
+    prefix_index = PrefixIndex(args.prefix_block)
+pool = BackendPool(args.llama_api.split(","), balance=args.balance, eject_after=args.eject_after,
+                   prefix_index=prefix_index,
+                   affinity_slack=args.affinity_slack, max_concurrency=args.max_concurrency)
+
+
+class Ticket:
+    def __init__(self, scheduler, lane, wait=0.0):
+        self.scheduler = scheduler
+        self.lane = lane
+        self.wait = wait
+        self.started = time.monotonic()
+        self.released = False
+
+    def release(self):
+        if (not self.released):
+            self.released = True
+            self.scheduler.release(self)
+
+
+# Admission control in front of the backends. At most max_concurrency requests per healthy backend run
+# at once, the rest wait in two lanes: short jobs are always served first, while long jobs may only fill
+# long_share of the slots so batch work cannot crowd out interactive chats. Within a lane the waiting
+# callers are served round robin by key, so one busy API key does not starve the others.
+class Scheduler:
+    def __init__(self, pool, max_concurrency=4, max_queue=100, max_wait=30.0, long_share=0.5):
+        self.pool = pool
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.long_share = long_share
+        self.lanes = {"short": OrderedDict(), "long": OrderedDict()}
+        # Shared between workers, while each worker keeps its own waiters
+        self.running = SharedCounters(("short", "long"), per_worker=("short", "long"))
+        self.waiting = SharedCounters(("short", "long"), per_worker=("short", "long"))
+        # Moving average of how long a request holds its slot, used for Retry-After
+        self.service_time = 1.0
+
+    def capacity(self):
+        return max(1, sum(1 for b in self.pool.backends if b.healthy)) * self.max_concurrency
+
+    @property
+    def queued(self):
+        return self.waiting["short"] + self.waiting["long"]
+
+    # Slots the requests of `lane` may occupy at once
+    def lane_capacity(self, lane):
+        if (lane == "long"):
+            return max(1, math.floor(self.capacity() * self.long_share))
+        return self.capacity()
+
+    def can_run(self, lane):
+        if (self.running["short"] + self.running["long"] >= self.capacity()):
+            return False
+        if (lane == "long"):
+            return self.running["long"] < self.lane_capacity("long")
+        return True
+
+    # Take a slot of `lane` if one is free. The check and the increment share the lock, so two workers
+    # cannot both take the last slot.
+    def claim(self, lane):
+        with self.running.lock:
+            if (not self.can_run(lane)):
+                return False
+            self.running.add(lane, 1)
+            return True
+
+    def retry_after(self):
+        return str(max(1, math.ceil(self.service_time * (self.queued + 1) / self.capacity())))
+
+    async def acquire(self, key, lane):
+        if (not self.max_concurrency):
+            return Ticket(self, None)
+        # Only skip the queue when nobody with an equal or better claim is waiting in any worker
+        if (not self.waiting["short"] and not (lane == "long" and self.waiting["long"]) and self.claim(lane)):
+            return Ticket(self, lane)
+        if (self.queued >= self.max_queue):
+            raise HTTPException(status_code=429, detail="Too many queued requests",
+                                headers={"Retry-After": self.retry_after()})
+
+        start = time.monotonic()
+        waiter = asyncio.get_running_loop().create_future()
+        self.lanes[lane].setdefault(key, deque()).append(waiter)
+        self.waiting.add(lane, 1)
+        try:
+            await asyncio.wait({waiter}, timeout=self.max_wait)
+        except asyncio.CancelledError:
+            # The client went away while queued, hand back a slot that may just have been granted
+            if (waiter.done()):
+                Ticket(self, lane).release()
+            else:
+                self.remove(lane, key, waiter)
+                waiter.cancel()
+            raise
+        if (not waiter.done()):
+            self.remove(lane, key, waiter)
+            waiter.cancel()
+            raise HTTPException(status_code=429, detail="Timed out waiting for a llama.cpp server",
+                                headers={"Retry-After": self.retry_after()})
+        return Ticket(self, lane, wait=time.monotonic() - start)
+
+    def remove(self, lane, key, waiter):
+        waiters = self.lanes[lane].get(key)
+        if (waiters is not None and waiter in waiters):
+            waiters.remove(waiter)
+            self.waiting.add(lane, -1)
+            if (not waiters):
+                del self.lanes[lane][key]
+
+    def release(self, ticket):
+        if (ticket.lane is None):
+            return
+        self.running.add(ticket.lane, -1)
+        self.service_time = 0.9 * self.service_time + 0.1 * (time.monotonic() - ticket.started)
+        self.dispatch()
+
+    def dispatch(self):
+        # A long job only runs where a short one could and no short one is waiting, in this worker or another
+        for lane in ("short", "long"):
+            while (self.lanes[lane] and not (lane == "long" and self.waiting["short"]) and self.claim(lane)):
+                # Take the first key's oldest waiter and move the key to the back of the lane
+                key, waiters = self.lanes[lane].popitem(last=False)
+                waiter = waiters.popleft()
+                self.waiting.add(lane, -1)
+                if (waiters):
+                    self.lanes[lane][key] = waiters
+                waiter.set_result(None)
+
+    # Slots freed by other workers are not announced, so with several workers the queue looks for them
+    async def dispatch_loop(self, interval=0.02):
+        while True:
+            await asyncio.sleep(interval)
+            self.dispatch()
+
+
+scheduler = Scheduler(pool, max_concurrency=args.max_concurrency, max_queue=args.max_queue,
+                      max_wait=args.max_queue_wait, long_share=args.long_lane_share)
+
+
+# Callers are scheduled fairly by API key, falling back to the OpenAI user field and the client address
+def fairness_key(request, body):
+    auth = request.headers.get("Authorization", "").split()
+    if (len(auth) == 2):
+        return auth[1]
+    if (is_present(body, "user")):
+        return str(body["user"])
+    return request.client.host if (request.client) else ""
+
+
+# The number of tokens a request may generate, None when it is not bounded (no max_tokens, or -1)
+def token_limit(postData):
+    n_predict = postData.get("n_predict")
+    return n_predict if (isinstance(n_predict, int) and n_predict > 0) else None
+
+
+# Requests without a token limit may run until the context is full, so they go to the long lane
+def request_lane(postData):
+    n_predict = token_limit(postData)
+    return "long" if (n_predict is None or n_predict > args.long_max_tokens) else "short"
+
+
+# Rough number of tokens a request keeps a backend busy for, used by the token-budget balancer
+def request_cost(postData):
+    n_predict = token_limit(postData)
+    return len(postData.get("prompt", "")) // 4 + (n_predict if (n_predict is not None) else max(512, args.long_max_tokens))
+
+
+# Pin the request to the slot holding its prefix, under both the old and the new server.cpp field name
+def with_slot(postData, slot):
+    if (slot is None):
+        return postData
+    return dict(postData, slot_id=slot, id_slot=slot)
+
+
+# server.cpp turns down a request pinned to a slot that is still busy. Requests that were not pinned hold
+# slots busy_slots does not know about, so such a request is sent once more without the slot.
+def slot_rejected(body):
+    return b"slot unavailable" in body
+
+
+# POST a non-stream request and return the decoded answer, retrying on another backend when the chosen
+# one is unreachable or overloaded. Completions are routed to the backend caching their prompt prefix.
+async def upstream_post(path, postData, cost=0, timer=None):
+    prompt = postData.get("prompt") if (path == "/completion") else None
+    prompt = prompt if (isinstance(prompt, str)) else None
+    tried = []
+    for attempt in range(args.max_retries + 1):
+        backend, slot = pool.pick(exclude=tried, prompt=prompt, model=postData.get("model"))
+        if (backend is None):
+            break
+        tried.append(backend)
+        if (timer):
+            timer.backend = backend.url
+        for slot in ((slot, None) if (slot is not None) else (None,)):
+            async with pool.use(backend, cost, slot):
+                try:
+                    res = await client.post(backend.url + path, content=json_dumps(with_slot(postData, slot)),
+                                            extensions={"trace": timer.trace} if (timer) else {})
+                except httpx.TransportError:
+                    pool.mark_failure(backend)
+                    metrics.inc("oai_upstream_errors_total", (("backend", backend.url), ("path", path)))
+                    break
+            if (res.status_code != 200 and slot is not None and slot_rejected(res.content)):
+                continue
+            if (res.status_code in (502, 503, 504)):
+                pool.mark_failure(backend)
+                metrics.inc("oai_upstream_errors_total", (("backend", backend.url), ("path", path)))
+                break
+            pool.mark_success(backend)
+            if (res.status_code != 200):
+                raise HTTPException(status_code=res.status_code, detail=res.text)
+            data = res.json()
+            data["model"] = pool.model_of(backend, data)
+            if (prompt is not None):
+                pool.remember(backend, prompt, data)
+            return data
+    raise HTTPException(status_code=502, detail="No llama.cpp server available")
+
+
+# Open a streamed request and yield (backend, the parts of its body). Transport errors before the first
+# part and overloaded backends are retried, since nothing has been relayed yet, and other errors are
+# raised with the upstream body.
+@asynccontextmanager
+async def upstream_stream(path, postData, cost=0, timer=None):
+    prompt = postData.get("prompt") if (path == "/completion") else None
+    prompt = prompt if (isinstance(prompt, str)) else None
+    tried = []
+    for attempt in range(args.max_retries + 1):
+        backend, slot = pool.pick(exclude=tried, prompt=prompt, model=postData.get("model"))
+        if (backend is None):
+            break
+        tried.append(backend)
+        if (timer):
+            timer.backend = backend.url
+        for slot in ((slot, None) if (slot is not None) else (None,)):
+            async with pool.use(backend, cost, slot):
+                request = client.build_request("POST", backend.url + path,
+                                               content=json_dumps(with_slot(postData, slot)),
+                                               extensions={"trace": timer.trace} if (timer) else {})
+                try:
+                    res = await client.send(request, stream=True)
+                except httpx.TransportError:
+                    pool.mark_failure(backend)
+                    metrics.inc("oai_upstream_errors_total", (("backend", backend.url), ("path", path)))
+                    break
+                try:
+                    if (res.status_code != 200 and slot is not None and slot_rejected(await res.aread())):
+                        continue
+                    if (res.status_code in (502, 503, 504)):
+                        pool.mark_failure(backend)
+                        metrics.inc("oai_upstream_errors_total", (("backend", backend.url), ("path", path)))
+                        break
+                    if (res.status_code != 200):
+                        pool.mark_success(backend)
+                        detail = (await res.aread()).decode(errors="replace")
+                        raise HTTPException(status_code=res.status_code, detail=detail)
+                    # A backend that resets the connection or times out before the first part is retried
+                    # as well, the client has not been sent anything from it
+                    parts = res.aiter_bytes()
+                    try:
+                        first = await parts.__anext__()
+                    except StopAsyncIteration:
+                        first = b""
+                    except httpx.TransportError:
+                        pool.mark_failure(backend)
+                        metrics.inc("oai_upstream_errors_total", (("backend", backend.url), ("path", path)))
+                        break
+                    pool.mark_success(backend)
+                    yield backend, resume_parts(first, parts)
+                finally:
+                    await res.aclose()
+                return
+    raise HTTPException(status_code=502, detail="No llama.cpp server available")
+
+
+# The parts of a body whose first part has already been read
+async def resume_parts(first, parts):
+    if (first):
+        yield first
+    async for part in parts:
+        yield part
 
-    body = await request.json()  # Use request.json() to parse JSON data
 
+# The seed a request asked for, None when the sampling is random ("seed": null or -1)
+def fixed_seed(postData):
+    seed = postData.get("seed")
+    return seed if (isinstance(seed, int) and seed >= 0) else None
+
+
+# Two tier cache of server.cpp answers keyed on the normalized request. Entries live in a memory LRU
+# and optionally as files in cache_dir, the oldest of which are deleted once the directory grows past
+# max_disk bytes. Both tiers expire entries after ttl seconds.
+class ResponseCache:
+    def __init__(self, max_entries=1024, cache_dir="", max_disk=0, ttl=86400.0):
+        self.max_entries = max_entries
+        self.cache_dir = cache_dir
+        self.max_disk = max_disk
+        self.ttl = ttl
+        self.memory = OrderedDict()
+        self.stats = {"hits_memory": 0, "hits_disk": 0, "misses": 0, "stores": 0, "evictions": 0}
+        self.disk_size = 0
+        self.writes = set()
+        # Bumped by clear(), answers asked for before are not stored
+        self.epoch = 0
+        if (cache_dir):
+            os.makedirs(cache_dir, exist_ok=True)
+            self.disk_size = sum(entry.stat().st_size for entry in os.scandir(cache_dir) if entry.is_file())
+
+    # Only requests that give the same answer every time are worth caching
+    def cacheable(self, postData):
+        return postData.get("temperature", 0.8) == 0 or fixed_seed(postData) is not None
+
+    def key(self, postData):
+        normalized = {k: v for k, v in postData.items() if k != "stream"}
+        return hashlib.sha256(json.dumps(normalized, sort_keys=True).encode()).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key + ".json")
+
+    async def get(self, postData):
+        key = self.key(postData)
+        entry = self.memory.get(key)
+        if (entry is not None and time.time() - entry[0] < self.ttl):
+            self.memory.move_to_end(key)
+            self.stats["hits_memory"] += 1
+            return entry[1]
+        if (self.cache_dir):
+            entry = await asyncio.to_thread(self.read, key)
+            if (entry is not None):
+                self.remember(key, entry[1], entry[0])
+                self.stats["hits_disk"] += 1
+                return entry[1]
+        self.stats["misses"] += 1
+        return None
+
+    def put(self, postData, value, epoch=None):
+        if (epoch is not None and epoch != self.epoch):
+            return
+        key = self.key(postData)
+        self.remember(key, value, time.time())
+        self.stats["stores"] += 1
+        if (self.cache_dir):
+            # Write in a thread and keep a reference so the task is not collected half way
+            task = asyncio.create_task(asyncio.to_thread(self.write, key, value))
+            self.writes.add(task)
+            task.add_done_callback(self.writes.discard)
+
+    def remember(self, key, value, created):
+        self.memory[key] = (created, value)
+        self.memory.move_to_end(key)
+        while (len(self.memory) > self.max_entries):
+            self.memory.popitem(last=False)
+            self.stats["evictions"] += 1
+
+    def read(self, key):
+        try:
+            created = os.path.getmtime(self.path(key))
+            if (time.time() - created >= self.ttl):
+                os.remove(self.path(key))
+                return None
+            with open(self.path(key), "rb") as f:
+                return created, json_loads(f.read())
+        except (OSError, ValueError):
+            return None
+
+    def write(self, key, value):
+        data = json_dumps(value)
+        tmp = "{}.{}.tmp".format(self.path(key), os.getpid())
+        with open(tmp, "wb") as f:
+            f.write(data)
+        try:
+            self.disk_size -= os.path.getsize(self.path(key))
+        except OSError:
+            pass
+        os.replace(tmp, self.path(key))
+        self.disk_size += len(data)
+        if (self.disk_size > self.max_disk):
+            self.trim()
+
+    # Forget every answer, once the backends may serve other models
+    async def clear(self):
+        self.epoch += 1
+        self.memory.clear()
+        if (self.cache_dir):
+            await asyncio.gather(*self.writes, return_exceptions=True)
+            await asyncio.to_thread(self.remove_files)
+
+    def remove_files(self):
+        for entry in os.scandir(self.cache_dir):
+            try:
+                if (entry.is_file()):
+                    os.remove(entry.path)
+            except OSError:
+                pass
+        self.disk_size = 0
+
+    def trim(self):
+        entries = sorted((entry for entry in os.scandir(self.cache_dir)
+                          if entry.is_file() and not entry.name.endswith(".tmp")),
+                         key=lambda entry: entry.stat().st_mtime)
+        self.disk_size = sum(entry.stat().st_size for entry in entries)
+        for entry in entries:
+            if (self.disk_size <= self.max_disk * 0.9):
+                break
+            try:
+                size = entry.stat().st_size
+                os.remove(entry.path)
+            except OSError:
+                continue
+            self.disk_size -= size
+            self.stats["evictions"] += 1
+
+
+# Several workers share answers through the disk tier, in the state directory unless --cache-dir is set
+cache_dir = args.cache_dir or (os.path.join(state_dir, "cache") if (shared) else "")
+response_cache = ResponseCache(args.cache_size, cache_dir, args.cache_disk_size * 1024 * 1024,
+                               args.cache_ttl) if (args.cache) else None
+
+
+# An OpenAI chunk of one choice serialized once, split around its content. Per token only the content
+# string is encoded and spliced between the fixed parts picked by the finish reason.
+class ChunkEncoder:
+    CONTENT = "\0content\0"
+
+    def __init__(self, chat=False, time_now=0, index=0, model=DEFAULT_MODEL):
+        self.start = None
+        if (chat):
+            resData = make_resData_stream({}, chat=True, time_now=time_now, start=True, index=index, model=model)
+            self.start = b"data: " + json_dumps(resData) + b"\n\n"
+        self.parts = {}
+        for reason in (None, "stop", "length"):
+            resData = make_resData_stream({"content": self.CONTENT, "stop": False}, chat=chat, time_now=time_now,
+                                          index=index, model=model)
+            resData["choices"][0]["finish_reason"] = reason
+            encoded = b"data: " + json_dumps(resData) + b"\n\n"
+            self.parts[reason] = tuple(encoded.split(json_dumps(self.CONTENT)))
+
+    def encode(self, content, finish_reason=None):
+        head, tail = self.parts[finish_reason]
+        return head + json_dumps(content) + tail
+
+
+# Re-encode server.cpp chunks as OpenAI SSE events for choice `index`
+async def openai_stream(chunks, chat=False, index=0, model=DEFAULT_MODEL):
+    encoder = ChunkEncoder(chat=chat, time_now=int(time.time()), index=index, model=model)
+    if (encoder.start is not None):
+        yield encoder.start
+
+    async for chunk in chunks:
+        if (chunk["stop"]):
+            yield encoder.encode(chunk["content"],
+                                 "stop" if (chunk["stopped_eos"] or chunk["stopped_word"]) else "length")
+            break
+        yield encoder.encode(chunk["content"])
+
+
+async def sse_events(events):
+    async for event in events:
+        yield event
+    yield b"data: [DONE]\n\n"
+
+
+# Split the upstream body into SSE data: payloads without decoding it to str
+async def sse_data(parts):
+    buffer = b""
+    async for part in parts:
+        buffer += part
+        if (b"\n" not in part):
+            continue
+        lines = buffer.split(b"\n")
+        buffer = lines.pop()
+        for line in lines:
+            if (line.startswith(b"data: ")):
+                yield line[6:]
+    if (buffer.startswith(b"data: ")):
+        yield buffer[6:]
+
+
+# Aho-Corasick automaton over the stop strings of a request. States are prefixes of stop strings, `depth`
+# is the length of that prefix and `match` the longest stop string ending in the state.
+class StopMatcher:
+    def __init__(self, stops):
+        self.goto = [{}]
+        self.fail = [0]
+        self.depth = [0]
+        self.match = [""]
+        for stop in stops:
+            state = 0
+            for char in stop:
+                if (char not in self.goto[state]):
+                    self.goto[state][char] = len(self.goto)
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.depth.append(self.depth[state] + 1)
+                    self.match.append("")
+                state = self.goto[state][char]
+            self.match[state] = stop
+        # Breadth first, so the failure state of a parent is known before its children
+        queue = deque(self.goto[0].values())
+        while (queue):
+            state = queue.popleft()
+            for char, child in self.goto[state].items():
+                queue.append(child)
+                fail = self.fail[state]
+                while (fail and char not in self.goto[fail]):
+                    fail = self.fail[fail]
+                self.fail[child] = self.goto[fail].get(char, 0) if (state) else 0
+                if (not self.match[child]):
+                    self.match[child] = self.match[self.fail[child]]
+
+    def step(self, state, char):
+        while (state and char not in self.goto[state]):
+            state = self.fail[state]
+        return self.goto[state].get(char, 0)
+
+
+# The same stop strings come with most requests, so their automata are kept
+@functools.lru_cache(maxsize=64)
+def compile_stops(stops):
+    return StopMatcher(stops)
+
+
+def stop_matcher(stops):
+    stops = tuple(stop for stop in stops or () if (stop))
+    return compile_stops(stops) if (stops) else None
+
+
+# Applies the stop strings to a stream of server.cpp chunks. Text is sent once it cannot be the start of a
+# stop string, so only the tail that may still grow into one is held back, and the chunk completing a
+# stop string ends the answer right before it. Such a stop chunk is made here from an intermediate chunk,
+# which lacks the prompt tokens and timings of the final one, so `cut` is set and the answer is not cached.
+class StopScanner:
+    def __init__(self, matcher):
+        self.matcher = matcher
+        self.state = 0
+        self.held = ""
+        self.tokens = 0
+        self.cut = False
+
+    # Return the chunk to send, or None while all of its text is held back
+    def relay(self, chunk):
+        self.tokens += 1
+        text = chunk["content"]
+        state = self.state
+        for i, char in enumerate(text):
+            state = self.matcher.step(state, char)
+            stop = self.matcher.match[state]
+            if (stop):
+                pending = self.held + text[:i + 1]
+                self.cut = True
+                return dict(chunk, content=pending[:len(pending) - len(stop)], stop=True, stopped_word=True,
+                            stopped_eos=False, stopping_word=stop, truncated=False,
+                            tokens_predicted=chunk.get("tokens_predicted", self.tokens))
+        pending = self.held + text
+        if (chunk["stop"]):
+            self.held = ""
+            return dict(chunk, content=pending)
+        self.state = state
+        cut = len(pending) - self.matcher.depth[state]
+        self.held = pending[cut:]
+        return dict(chunk, content=pending[:cut]) if (cut) else None
+
+
+# Relay the SSE stream of server.cpp as OpenAI chunks. The next upstream line is only read once the
+# client has taken the previous chunk, so a slow client slows generation down instead of piling up
+# buffers. If the client disconnects the generator is cancelled and leaving the `async with` closes the
+# upstream connection, which makes server.cpp stop generating for this request.
+# The stop strings are matched here rather than by server.cpp, which would hold back whole chunks, and
+# closing the connection on a match stops the generation.
+async def relay_stream(postData, ticket, timer, chat=False, index=0):
+    matcher = stop_matcher(postData.get("stop"))
+    upstreamData = dict(postData, stop=[]) if (matcher) else postData
+    try:
+        async with upstream_stream("/completion", upstreamData, cost=request_cost(postData),
+                                   timer=timer) as (backend, data):
+            async for event in openai_stream(upstream_chunks(postData, backend, data, timer, matcher), chat=chat,
+                                             index=index, model=pool.model_of(backend)):
+                yield event
+    finally:
+        ticket.release()
+        timer.finish()
+
+
+# Decode the upstream data: lines, apply the stop strings, and once the answer is complete record where
+# its prompt is cached and store it in the response cache
+async def upstream_chunks(postData, backend, data, timer, matcher=None):
+    epoch = response_cache.epoch if (response_cache) else 0
+    content = []
+    scanner = StopScanner(matcher) if (matcher) else None
+    async for line in sse_data(data):
+        chunk = json_loads(line)
+        timer.token()
+        if (scanner is not None):
+            chunk = scanner.relay(chunk)
+            if (chunk is None):
+                continue
+        content.append(chunk["content"])
+        if (chunk["stop"]):
+            final = timer.data = dict(chunk, content="".join(content), model=pool.model_of(backend, chunk))
+            pool.remember(backend, postData["prompt"], final)
+            cut = scanner is not None and scanner.cut
+            if (response_cache and response_cache.cacheable(postData) and not cut):
+                response_cache.put(postData, {"data": final, "chunks": content}, epoch)
+        yield chunk
+        if (chunk["stop"]):
+            return
+
+
+# Replay a cached answer with the same chunking as when it was generated
+async def cached_chunks(cached):
+    chunks = cached.get("chunks") or [cached["data"]["content"]]
+    for content in chunks[:-1]:
+        yield {"content": content, "stop": False}
+    yield dict(cached["data"], content=chunks[-1], stop=True)
+
+
+async def lookup_cache(postData, timer):
+    if (response_cache is None or not response_cache.cacheable(postData)):
+        return None
+    cached = await response_cache.get(postData)
+    if (cached is not None):
+        timer.cached = True
+        timer.finish()
+    return cached
+
+
+async def acquire_ticket(request, body, postData, timer):
+    try:
+        ticket = await scheduler.acquire(fairness_key(request, body), request_lane(postData))
+    except BaseException:
+        timer.finish()
+        raise
+    timer.queued(ticket)
+    return ticket
+
+
+# Answer one server.cpp request without streaming, from the cache or from a backend
+async def generate_once(request, body, postData):
+    timer = RequestTimer(request.url.path)
+    cached = await lookup_cache(postData, timer)
+    if (cached is not None):
+        return cached["data"]
+    ticket = await acquire_ticket(request, body, postData, timer)
+    epoch = response_cache.epoch if (response_cache) else 0
+    try:
+        data = timer.data = await upstream_post("/completion", postData, cost=request_cost(postData), timer=timer)
+    finally:
+        ticket.release()
+        timer.finish()
+    if (response_cache and response_cache.cacheable(postData)):
+        response_cache.put(postData, {"data": data}, epoch)
+    return data
+
+
+# Stream one server.cpp request as choice `index`. The single choice case looks up the cache and takes
+# its ticket itself, otherwise the stream does so on its first event.
+async def stream_choice(request, body, postData, timer, chat=False, index=0, cached=None, ticket=None):
+    if (cached is None and ticket is None):
+        cached = await lookup_cache(postData, timer)
+    if (cached is not None):
+        events = openai_stream(cached_chunks(cached), chat=chat, index=index,
+                               model=cached["data"].get("model") or DEFAULT_MODEL)
+    else:
+        if (ticket is None):
+            ticket = await acquire_ticket(request, body, postData, timer)
+        events = relay_stream(postData, ticket, timer, chat=chat, index=index)
+    async for event in events:
+        yield event
+
+
+# Run streams up to their first event, which takes their ticket and opens the upstream request, so a full
+# queue or a failing backend is answered with an error status instead of inside a started response.
+# Returns streams that start with that event again.
+async def start_streams(streams):
+    async def first_event(stream):
+        return await stream.__anext__()
+
+    async def replay(first, stream):
+        try:
+            yield first
+            async for event in stream:
+                yield event
+        finally:
+            await stream.aclose()
+
+    tasks = [asyncio.create_task(first_event(stream)) for stream in streams]
+    try:
+        firsts = await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await asyncio.gather(*[stream.aclose() for stream in streams], return_exceptions=True)
+        raise
+    return [replay(first, stream) for first, stream in zip(firsts, streams)]
+
+
+# Interleave the events of several streams as they arrive. The queue is small, so a slow client still
+# holds back the upstream reads, and leaving early closes every stream.
+async def merge_streams(streams):
+    queue = asyncio.Queue(maxsize=len(streams))
+
+    async def pump(stream):
+        try:
+            async for event in stream:
+                await queue.put(event)
+            await queue.put(None)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            await queue.put(e)
+        finally:
+            await stream.aclose()
+
+    tasks = [asyncio.create_task(pump(stream)) for stream in streams]
+    try:
+        remaining = len(tasks)
+        while (remaining):
+            event = await queue.get()
+            if (event is None):
+                remaining -= 1
+            elif (isinstance(event, Exception)):
+                raise event
+            else:
+                yield event
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+# Run coroutines concurrently, cancelling the others as soon as one fails
+async def gather_all(coroutines):
+    tasks = [asyncio.create_task(coroutine) for coroutine in coroutines]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        raise
+
+
+# LRU of prompt tokenizations for the tokenize option, keyed on the model and the whole prompt. Tokens can
+# merge across any boundary, so a prompt is always tokenized as one piece, by a backend serving its model.
+class TokenCache:
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        tokens = self.entries.get(key)
+        if (tokens is not None):
+            self.entries.move_to_end(key)
+        return tokens
+
+    def put(self, key, tokens):
+        if (self.max_entries <= 0):
+            return
+        self.entries[key] = tokens
+        self.entries.move_to_end(key)
+        while (len(self.entries) > self.max_entries):
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+
+    async def tokenize(self, postData):
+        prompt = postData["prompt"]
+        if (not isinstance(prompt, str)):
+            return prompt
+        key = (postData.get("model"), prompt)
+        tokens = self.get(key)
+        if (tokens is None):
+            tokenData = {"content": prompt}
+            if (is_present(postData, "model")): tokenData["model"] = postData["model"]
+            tokens = (await upstream_post("/tokenize", tokenData))["tokens"]
+            self.put(key, tokens)
+        return tokens
+
+
+token_cache = TokenCache(args.tokenize_cache_size)
+
+
+# Split a request into the server.cpp requests answering it: one per prompt of a batch, times n choices.
+# A prompt may itself be a list of tokens. A fixed seed is offset per choice so the choices still differ.
+def expand_postData(postData, n=1):
+    prompts = postData["prompt"]
+    if (not (isinstance(prompts, list) and prompts and isinstance(prompts[0], (str, list)))):
+        prompts = [prompts]
+    expanded = []
+    for prompt in prompts:
+        for i in range(n):
+            choiceData = dict(postData, prompt=prompt)
+            if (i and fixed_seed(choiceData) is not None):
+                choiceData["seed"] += i
+            expanded.append(choiceData)
+    return expanded, len(prompts)
+
+
+async def answer(request, body, chat=False):
     stream = False
     tokenize = False
-
+    n = 1
     if (is_present(body, "stream")): stream = body["stream"]
     if (is_present(body, "tokenize")): tokenize = body["tokenize"]
+    if (is_present(body, "n")): n = max(1, int(body["n"] or 1))
+    postData = make_postData(body, chat=chat, stream=stream)
+    postDatas, n_prompts = expand_postData(postData, n)
 
-    postData = make_postData(body, chat=True, stream=stream)
+    if (not stream):
+        # The prompt tokens are only reported in non-stream answers, and are looked up while generating
+        tokenizing = None
+        if (tokenize):
+            tokenizing = asyncio.create_task(gather_all([token_cache.tokenize(postDatas[i * n])
+                                                         for i in range(n_prompts)]))
+        try:
+            datas = await gather_all([generate_once(request, body, p) for p in postDatas])
+            promptToken = await tokenizing if (tokenizing) else []
+        except BaseException:
+            if (tokenizing):
+                tokenizing.cancel()
+            raise
+        if (tokenize and n_prompts == 1):
+            promptToken = promptToken[0]
+        if (len(datas) == 1):
+            return make_resData(datas[0], chat=chat, promptToken=promptToken)
+        return merge_resData(datas, chat=chat, promptToken=promptToken, n=n)
 
-    promptToken = []
-    if (tokenize):
-        tokenData = requests.request("POST", urllib.parse.urljoin(args.llama_api, "/tokenize"),
-                                     data=json.dumps({"content": postData["prompt"]})).json()
-        promptToken = tokenData["tokens"]
+    if (len(postDatas) > 1):
+        # Every choice takes its ticket before the response starts and holds it until the end, so more
+        # choices than the lane has slots would wait for each other forever
+        slots = scheduler.lane_capacity(request_lane(postData))
+        if (scheduler.max_concurrency and len(postDatas) > slots):
+            raise HTTPException(status_code=400, detail=f"Streaming {len(postDatas)} choices needs as many "
+                                                        f"request slots, there are {slots}")
+        streams = await start_streams([stream_choice(request, body, p, RequestTimer(request.url.path), chat=chat,
+                                                     index=i) for i, p in enumerate(postDatas)])
+        return StreamingResponse(sse_events(merge_streams(streams)), media_type='text/event-stream')
 
-    if (not stream):
-        data = requests.request("POST", urllib.parse.urljoin(args.llama_api, "/completion"), data=json.dumps(postData))
-        print(data.json())
-        resData = make_resData(data.json(), chat=True, promptToken=promptToken)
-        return resData  # Return the JSON response directly
-    else:
-        async def generate():
-            data = requests.request("POST", urllib.parse.urljoin(args.llama_api, "/completion"),
-                                    data=json.dumps(postData), stream=True)
-            time_now = int(time.time())
-            resData = make_resData_stream({}, chat=True, time_now=time_now, start=True)
-            yield 'data: {}\n\n'.format(json.dumps(resData))
-            for line in data.iter_lines():
-                if line:
-                    decoded_line = line.decode('utf-8')
-                    resData = make_resData_stream(json.loads(decoded_line[6:]), chat=True, time_now=time_now)
-                    yield 'data: {}\n\n'.format(json.dumps(resData))
-
-        # Use StreamingResponse to stream the data
-        return StreamingResponse(generate(), media_type='text/event-stream')
+    timer = RequestTimer(request.url.path)
+    cached = await lookup_cache(postData, timer)
+    if (cached is not None):
+        return StreamingResponse(sse_events(stream_choice(request, body, postData, timer, chat=chat, cached=cached)),
+                                 media_type='text/event-stream')
+    ticket = await acquire_ticket(request, body, postData, timer)
+    try:
+        events, = await start_streams([stream_choice(request, body, postData, timer, chat=chat, ticket=ticket)])
+    except BaseException:
+        ticket.release()
+        timer.finish()
+        raise
+    return StreamingResponse(sse_events(events), media_type='text/event-stream',
+                             background=BackgroundTask(ticket.release))
+
+
+# Embedding of one input by server.cpp. The inputs are scheduled in the long lane, so a large indexing job
+# cannot crowd out chats, and like deterministic completions they are kept in the response cache.
+async def embed_one(request, body, content, timer):
+    postData = {"content": content}
+    if (is_present(body, "model")): postData["model"] = body["model"]
+    key = dict(postData, path="/embedding")
+    if (response_cache):
+        cached = await response_cache.get(key)
+        if (cached is not None):
+            return cached["data"]
+    ticket = await scheduler.acquire(fairness_key(request, body), "long")
+    timer.queued(ticket)
+    epoch = response_cache.epoch if (response_cache) else 0
+    try:
+        cost = len(content) // 4 if (isinstance(content, str)) else len(content)
+        data = await upstream_post("/embedding", postData, cost=cost, timer=timer)
+    finally:
+        ticket.release()
+    if (response_cache):
+        response_cache.put(key, {"data": data}, epoch)
+    return data
+
+
+# Pack an embedding as little endian float32 for encoding_format=base64, straight from the array buffer
+def pack_embedding(embedding):
+    values = array.array("f", embedding)
+    if (sys.byteorder == "big"):
+        values.byteswap()
+    return base64.b64encode(memoryview(values)).decode()
+
+
+# Embed every input, with at most --embedding-concurrency of them spread over the backends at once so the
+# next input starts as soon as any finishes. A token array is one input, an array of strings or token
+# arrays several.
+async def embeddings(request, body):
+    inputs = body.get("input")
+    if (isinstance(inputs, str) or (isinstance(inputs, list) and inputs and isinstance(inputs[0], int))):
+        inputs = [inputs]
+    if (not isinstance(inputs, list) or not inputs):
+        raise HTTPException(status_code=400, detail="input must be a string, an array of strings or token arrays")
+    encoding_format = body.get("encoding_format") or "float"
+    if (encoding_format not in ("float", "base64")):
+        raise HTTPException(status_code=400, detail="encoding_format must be float or base64")
+
+    timer = RequestTimer(request.url.path)
+    window = asyncio.Semaphore(max(1, args.embedding_concurrency))
+
+    async def embed(content):
+        async with window:
+            return await embed_one(request, body, content, timer)
+
+    try:
+        results = await gather_all([embed(content) for content in inputs])
+    finally:
+        timer.finish()
+
+    data = []
+    prompt_tokens = 0
+    for index, (content, result) in enumerate(zip(inputs, results)):
+        embedding = result["embedding"]
+        data.append({
+            "object": "embedding",
+            "index": index,
+            "embedding": pack_embedding(embedding) if (encoding_format == "base64") else embedding
+        })
+        # server.cpp does not report the tokens of an embedding, only token inputs are counted exactly
+        prompt_tokens += result.get("tokens_evaluated", len(content) if (isinstance(content, list)) else 0)
+    resData = {
+        "object": "list",
+        "data": data,
+        "model": results[0].get("model") or DEFAULT_MODEL,
+        "usage": {
+            "prompt_tokens": prompt_tokens,
+            "total_tokens": prompt_tokens
+        }
+    }
+    # Large float arrays are serialized directly instead of through FastAPI's encoder
+    return Response(content=json_dumps(resData), media_type="application/json")
+
+
+# Count every response by route and status. A plain ASGI middleware, so streamed bodies pass through untouched.
+class MetricsMiddleware:
+    def __init__(self, app):
+        self.app = app
+        self.paths = None
+
+    async def __call__(self, scope, receive, send):
+        if (scope["type"] != "http"):
+            await self.app(scope, receive, send)
+            return
+        if (self.paths is None):
+            self.paths = {route.path for route in app.routes}
+        route = scope["path"] if (scope["path"] in self.paths) else "other"
+        status = [500]
+
+        async def send_status(message):
+            if (message["type"] == "http.response.start"):
+                status[0] = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_status)
+        finally:
+            metrics.inc("oai_requests_total", (("route", route), ("status", status[0])))
+
+
+app.add_middleware(MetricsMiddleware)
+
+
+def cache_summary():
+    return dict(response_cache.stats, entries=len(response_cache.memory), disk_bytes=response_cache.disk_size)
+
+
+# With several workers each one writes its metrics and cache counters to the state directory, and
+# whichever worker answers /metrics or /cache/stats adds them all up
+def write_worker_state():
+    state = {"metrics": metrics.snapshot(), "cache": cache_summary() if (response_cache) else None}
+    path = os.path.join(state_dir, "worker-{}.json".format(worker_id))
+    with open(path + ".tmp", "wb") as f:
+        f.write(json_dumps(state))
+    os.replace(path + ".tmp", path)
+
+
+def read_worker_states():
+    write_worker_state()
+    states = []
+    for entry in os.scandir(state_dir):
+        if (entry.name.startswith("worker-") and entry.name.endswith(".json")):
+            try:
+                with open(entry.path, "rb") as f:
+                    states.append(json_loads(f.read()))
+            except (OSError, ValueError):
+                continue
+    return states
+
+
+async def metrics_loop(interval=1.0):
+    while True:
+        await asyncio.sleep(interval)
+        await asyncio.to_thread(write_worker_state)
+
+
+def total_cache_summary(states):
+    total = {}
+    for state in states:
+        for name, value in (state["cache"] or {}).items():
+            # Every worker sees the same disk tier
+            total[name] = max(total.get(name, 0), value) if (name == "disk_bytes") else total.get(name, 0) + value
+    return total
+
+
+@app.get('/metrics')
+async def prometheus_metrics():
+    source = metrics
+    cache = cache_summary() if (response_cache) else {}
+    if (shared):
+        states = await asyncio.to_thread(read_worker_states)
+        source = Metrics()
+        for state in states:
+            source.merge(state["metrics"])
+        cache = total_cache_summary(states)
+    gauges = [(("oai_queue_depth", ()), scheduler.queued)]
+    for lane, running in scheduler.running.items():
+        gauges.append((("oai_running_requests", (("lane", lane),)), running))
+    for backend in pool.backends:
+        labels = (("backend", backend.url),)
+        gauges.append((("oai_backend_healthy", labels), int(backend.healthy)))
+        gauges.append((("oai_backend_outstanding_requests", labels), backend.outstanding))
+    if (response_cache):
+        for name in response_cache.stats:
+            gauges.append((("oai_cache_" + name, ()), cache[name]))
+    return PlainTextResponse(source.render(gauges), media_type="text/plain; version=0.0.4")
+
+
+@app.get('/cache/stats')
+async def cache_stats():
+    if (response_cache is None):
+        return {"enabled": False}
+    if (shared):
+        return dict(total_cache_summary(await asyncio.to_thread(read_worker_states)), enabled=True)
+    return dict(cache_summary(), enabled=True)
+
+
+@app.post('/chat/completions')
+@app.post('/v1/chat/completions')
+async def chat_completions(request: Request):
+    if (args.api_key != "" and request.headers["Authorization"].split()[1] != args.api_key):
+        return Response(status_code=403)
+
+    body = await request.json()  # Use request.json() to parse JSON data
+
+    return await answer(request, body, chat=True)
 
 
 @app.post('/completions')
 @app.post('/v1/completions')
-async def completion(body: dict):
+async def completion(request: Request):
     if (args.api_key != "" and request.headers["Authorization"].split()[1] != args.api_key):
         raise HTTPException(status_code=403, detail="Forbidden")
 
-    stream = False
-    tokenize = False
-    if (is_present(body, "stream")): stream = body["stream"]
-    if (is_present(body, "tokenize")): tokenize = body["tokenize"]
-    postData = make_postData(body, chat=False, stream=stream)
+    body = await request.json()
 
-    promptToken = []
-    if (tokenize):
-        tokenData = requests.request("POST", urllib.parse.urljoin(args.llama_api, "/tokenize"),
-                                     data=json.dumps({"content": postData["prompt"]})).json()
-        promptToken = tokenData["tokens"]
+    return await answer(request, body, chat=False)
 
-    if (not stream):
-        data = requests.request("POST", urllib.parse.urljoin(args.llama_api, "/completion"), data=json.dumps(postData))
-        print(data.json())
-        resData = make_resData(data.json(), chat=False, promptToken=promptToken)
-        return resData
-    else:
-        async def generate():
-            data = requests.request("POST", urllib.parse.urljoin(args.llama_api, "/completion"),
-                                    data=json.dumps(postData), stream=True)
-            time_now = int(time.time())
-            for line in data.iter_lines():
-                if line:
-                    decoded_line = line.decode('utf-8')
-                    resData = make_resData_stream(json.loads(decoded_line[6:]), chat=False, time_now=time_now)
-                    yield 'data: {}\n\n'.format(json.dumps(resData))
 
-        return Response(generate(), media_type='text/event-stream')
+@app.post('/embeddings')
+@app.post('/v1/embeddings')
+async def create_embeddings(request: Request):
+    if (args.api_key != "" and request.headers["Authorization"].split()[1] != args.api_key):
+        raise HTTPException(status_code=403, detail="Forbidden")
+
+    body = await request.json()
+
+    return await embeddings(request, body)
 
 
 @app.get('/models')
 @app.get('/v1/models')
-async def list_models():
+async def list_models(request: Request):
     if (args.api_key != "" and request.headers["Authorization"].split()[1] != args.api_key):
         raise HTTPException(status_code=403, detail="Forbidden")
 
-    # Define the available models here. You can add more as needed.
+    # The models the backends reported loading, or one placeholder while none is known
     models = [
         {
-            "id": "llama_cpp",
+            "id": model,
             "object": "model",
-            "created": 1686935002,
-            "owned_by": "organization-owner"
-        },
+            "created": created,
+            "owned_by": "llama.cpp"
+        } for model, created in pool.models().items()
     ]
+    if (not models):
+        models = [
+            {
+                "id": "llama_cpp",
+                "object": "model",
+                "created": 1686935002,
+                "owned_by": "organization-owner"
+            },
+        ]
 
-    return {"object": "list", "data": models, "object": "list"}
+    return {"object": "list", "data": models}
 
 
-if __name__ == '__main__':
+def check_admin(request):
+    if (args.admin_key == ""):
+        raise HTTPException(status_code=404, detail="Not Found")
+    auth = request.headers.get("Authorization", "").split()
+    if (len(auth) != 2 or auth[1] != args.admin_key):
+        raise HTTPException(status_code=403, detail="Forbidden")
+
+
+# Replaced backends are listed as draining while their requests finish, so the launcher knows when
+# their server.cpp can be stopped
+def describe_backends():
+    backends = [(b, False) for b in pool.backends] + [(b, True) for b in pool.draining_backends()]
+    return {"backends": [{"url": b.url, "model": b.model, "healthy": b.healthy, "outstanding": b.outstanding,
+                          "draining": draining} for b, draining in backends]}
+
+
+@app.get('/admin/backends')
+async def get_backends(request: Request):
+    check_admin(request)
+    return describe_backends()
+
+
+# Lets the launcher flip traffic to a server.cpp it has warmed up with the next model
+@app.post('/admin/backends')
+async def replace_backends(request: Request):
+    check_admin(request)
+    if (shared):
+        raise HTTPException(status_code=409, detail="The backends are fixed when running several workers")
+    body = await request.json()
+    urls = body.get("backends")
+    if (not isinstance(urls, list) or not urls or not all(isinstance(url, str) and url for url in urls)):
+        raise HTTPException(status_code=400, detail="backends must be a list of server.cpp addresses")
+    await pool.replace(urls)
+    # The backends may serve other models now, under the same names or for requests without one
+    if (response_cache):
+        await response_cache.clear()
+    token_cache.clear()
+    return describe_backends()
+
+
+def serve_worker(sock, worker):
+    global worker_id
+    worker_id = worker
     import uvicorn
 
-    uvicorn.run(app, host=args.host, port=args.port)
+    uvicorn.Server(uvicorn.Config(app, host=args.host, port=args.port)).run(sockets=[sock])
+
+
+# Zero what a dead worker left counted as running, waiting or outstanding
+def clear_worker(worker):
+    for counters in [scheduler.running, scheduler.waiting] + [backend.state for backend in pool.backends]:
+        counters.clear_worker(worker)
+
+
+# Run args.workers forked copies of the app on one listening socket and restart any that dies. The
+# shared state is created at import, so every worker inherits it, and the counts of a dead worker are
+# cleared before it is restarted.
+def run_workers():
+    sock = socket.create_server((args.host, args.port), backlog=2048)
+    context = multiprocessing.get_context("fork")
+
+    def start(worker):
+        process = context.Process(target=serve_worker, args=(sock, worker))
+        process.start()
+        return process
+
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    workers = {}
+    try:
+        for worker in range(args.workers):
+            workers[worker] = start(worker)
+        while True:
+            multiprocessing.connection.wait([process.sentinel for process in workers.values()])
+            for worker, process in list(workers.items()):
+                if (not process.is_alive()):
+                    print("worker {} exited with code {}, restarting".format(worker, process.exitcode), flush=True)
+                    clear_worker(worker)
+                    time.sleep(1)
+                    workers[worker] = start(worker)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for process in workers.values():
+            if (process.is_alive()):
+                process.terminate()
+        for process in workers.values():
+            process.join()
+        sock.close()
+        shutil.rmtree(state_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    if (shared):
+        run_workers()
+    else:
+        import uvicorn
+
+        uvicorn.run(app, host=args.host, port=args.port)
@@ -0,0 +1,23 @@
+import importlib.util
+import os
+
+import pytest
+
+pytest.importorskip("PyQt5")
+
+spec = importlib.util.spec_from_file_location(
+    "llama_cpp_qt", os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "llama.cpp-qt.py"))
+llama_cpp_qt = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(llama_cpp_qt)
+
+
+def test_json_log_lines_track_busy_slots():
+    stats = llama_cpp_qt.PerfStats()
+    stats.feed("model", '{"timestamp":1702000000,"level":"INFO","function":"launch_slot_with_data","line":871,'
+                        '"message":"slot is processing task","slot_id":1,"task_id":4}')
+    assert stats.busy["model"] == {1}
+    stats.feed("model", '{"timestamp":1702000002,"level":"INFO","function":"update_slots","line":1580,'
+                        '"message":"slot released","slot_id":1,"task_id":4,"n_ctx":2048,"n_past":40,'
+                        '"n_system_tokens":0,"n_cache_tokens":40,"truncated":false}')
+    assert stats.busy["model"] == set()
+    assert stats.n_slots["model"] == 2
@@ -0,0 +1,129 @@
+import asyncio
+import json
+import os
+import sys
+
+import httpx
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.argv = ["oai_api.py", "--cache", "--admin-key", "secret"]
+import oai_api  # noqa: E402
+
+WORDS = ["The", " quick", " brown", " fox", " jumps"]
+
+
+# A server.cpp answering /completion with WORDS, streamed as intermediate chunks and a final one
+def completion(request):
+    if (request.url.path != "/completion"):
+        return httpx.Response(404)
+    body = json.loads(request.content)
+    final = {"content": "", "stop": True, "stopped_eos": True, "stopped_word": False, "truncated": False,
+             "tokens_evaluated": 4, "tokens_predicted": len(WORDS), "slot_id": 0,
+             "timings": {"prompt_per_second": 100.0, "predicted_per_second": 10.0}}
+    if (not body.get("stream")):
+        return httpx.Response(200, json=dict(final, content="".join(WORDS)))
+    lines = [{"content": word, "stop": False, "slot_id": 0} for word in WORDS] + [final]
+    return httpx.Response(200, content="".join("data: " + json.dumps(line) + "\n\n" for line in lines).encode(),
+                          headers={"Content-Type": "text/event-stream"})
+
+
+async def post(path, body, headers=None):
+    oai_api.client = httpx.AsyncClient(transport=httpx.MockTransport(completion))
+    try:
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=oai_api.app),
+                                     base_url="http://proxy") as proxy:
+            return await proxy.post(path, json=body, headers=headers)
+    finally:
+        await oai_api.client.aclose()
+
+
+def test_stream_cut_at_stop_string_replays_as_non_stream():
+    body = {"prompt": "Say it", "temperature": 0, "stop": [" fox"], "max_tokens": 8}
+    streamed = asyncio.run(post("/v1/completions", dict(body, stream=True)))
+    assert streamed.status_code == 200
+    assert "brown" in streamed.text and "fox" not in streamed.text
+
+    answer = asyncio.run(post("/v1/completions", body))
+    assert answer.status_code == 200
+    assert answer.json()["usage"]["prompt_tokens"] == 4
+
+
+def test_prompts_are_tokenized_per_model(monkeypatch):
+    calls = []
+
+    async def upstream_post(path, postData, **kwargs):
+        calls.append(postData)
+        return {"tokens": [len(calls)]}
+
+    monkeypatch.setattr(oai_api, "upstream_post", upstream_post)
+    cache = oai_api.TokenCache()
+
+    async def tokenize():
+        return [await cache.tokenize({"prompt": "Hello", "model": model}) for model in ("a", "b", "a")]
+
+    assert asyncio.run(tokenize()) == [[1], [2], [1]]
+    assert calls == [{"content": "Hello", "model": "a"}, {"content": "Hello", "model": "b"}]
+
+
+CONVERSATION = [{"role": "system", "content": "Be brief."},
+                {"role": "user", "content": "Hi"},
+                {"role": "assistant", "content": "Hello"},
+                {"role": "user", "content": "Bye"}]
+
+
+def test_llama2_template_puts_the_system_prompt_in_the_first_instruction():
+    assert oai_api.chat_templates["llama2"].render(CONVERSATION) == (
+        "[INST] <<SYS>>\nBe brief.\n<</SYS>>\n\nHi [/INST] Hello </s><s>[INST] Bye [/INST]")
+
+
+def test_mistral_template_puts_the_system_prompt_in_the_first_instruction():
+    assert oai_api.chat_templates["mistral"].render(CONVERSATION) == (
+        "[INST] Be brief.\n\nHi [/INST]Hello</s> [INST] Bye [/INST]")
+
+
+def test_replacing_the_backends_forgets_cached_answers():
+    urls = [backend.url for backend in oai_api.pool.backends]
+    answer = asyncio.run(post("/v1/completions", {"prompt": "Remember me", "temperature": 0, "max_tokens": 8}))
+    assert answer.status_code == 200
+    assert oai_api.response_cache.memory
+    oai_api.token_cache.put((None, "Remember me"), [1, 2])
+
+    swapped = asyncio.run(post("/admin/backends", {"backends": ["http://127.0.0.1:9"]},
+                               headers={"Authorization": "Bearer secret"}))
+    asyncio.run(post("/admin/backends", {"backends": urls}, headers={"Authorization": "Bearer secret"}))
+    assert swapped.status_code == 200
+    assert not oai_api.response_cache.memory
+    assert oai_api.token_cache.get((None, "Remember me")) is None
+
+
+class ResetStream(httpx.AsyncByteStream):
+    async def __aiter__(self):
+        raise httpx.RemoteProtocolError("peer closed connection without sending complete message body")
+        yield b""
+
+
+@pytest.mark.parametrize("failure", ["reset", "timeout"])
+def test_stream_failing_before_its_first_data_is_retried(monkeypatch, failure):
+    def flaky(request):
+        if (request.url.host == "first"):
+            if (failure == "timeout"):
+                raise httpx.ReadTimeout("timed out", request=request)
+            return httpx.Response(200, stream=ResetStream(), headers={"Content-Type": "text/event-stream"})
+        return completion(request)
+
+    monkeypatch.setattr(oai_api.pool, "backends", [oai_api.Backend("http://first"), oai_api.Backend("http://second")])
+
+    async def stream():
+        oai_api.client = httpx.AsyncClient(transport=httpx.MockTransport(flaky))
+        try:
+            async with httpx.AsyncClient(transport=httpx.ASGITransport(app=oai_api.app),
+                                         base_url="http://proxy") as proxy:
+                return await proxy.post("/v1/completions", json={"prompt": "Go", "stream": True, "max_tokens": 8})
+        finally:
+            await oai_api.client.aclose()
+
+    answer = asyncio.run(stream())
+    assert answer.status_code == 200
+    assert "quick" in answer.text and answer.text.endswith("data: [DONE]\n\n")
+    assert oai_api.pool.backends[0].failures == 1